@@ -0,0 +1,229 @@
+"""A read-only JSON API for analysis scripts:
+
+    /api/ideas?stage=Validation&tag=Disagreement&fields=id,title,body
+    /api/posts?author=123&cursor=...
+    /api/authors
+    /api/sectors
+
+Each response is one page of results, along with the cursor (and URL) of
+the next page if there is one:
+
+    {"items": [{"id": 1, "title": "..."}, ...], "cursor": "...", "next": "..."}
+
+fields= picks the fields of each item; by default every field but body is
+included.  Ideas and posts may be filtered on the same facets as the browse
+pages, except that posts can't be filtered on their idea's stage or sector.
+Items are serialized one at a time as they are written out, rather than
+into one big string.
+"""
+
+import urllib
+
+from google.appengine.ext import db
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+from django.utils import simplejson as json
+
+from models import Idea, Post, Author, Sector, STAGES, prefetch_references
+from pagecache import cache_page
+
+
+def key_id(key):
+    return key and key.id()
+
+def date(value):
+    return value and value.isoformat()
+
+def reference(model, prop, attr):
+    """Returns a field that gives the named attribute of the entity that the
+    given ReferenceProperty points to."""
+    def field(entity):
+        if getattr(model, prop).get_value_for_datastore(entity) is None:
+            return None
+        return getattr(getattr(entity, prop), attr)
+    field.prefetch = prop
+    return field
+
+def parse_key(kind):
+    def parse(value):
+        return db.Key.from_path(kind, int(value))
+    return parse
+
+def parse_stage(value):
+    if value not in STAGES:
+        raise ValueError('unknown stage %r' % value)
+    return value
+
+
+class ApiHandler(webapp.RequestHandler):
+
+    # The model whose entities are listed
+    model = None
+
+    # Maps each field name to a function that returns its (JSON-serializable)
+    # value for an entity.  Fields whose function has a prefetch attribute
+    # need that reference resolved.
+    fields = {}
+
+    # Fields left out unless they're asked for
+    optional_fields = ('body',)
+
+    # Maps each filter's request parameter to the property it filters on and
+    # a function that converts the given value
+    filters = {}
+
+    page_size = 50
+    max_page_size = 500
+
+    def get_query(self):
+        return self.model.all()
+
+    @cache_page
+    def get(self):
+        try:
+            fields = self.get_fields()
+            q = self.get_query()
+            for param, (prop, convert) in sorted(self.filters.items()):
+                value = self.request.get(param)
+                if value:
+                    q.filter('%s =' % prop, convert(value))
+            size = max(1, min(int(self.request.get('limit') or
+                                  self.page_size), self.max_page_size))
+            cursor = self.request.get('cursor')
+            if cursor:
+                q.with_cursor(cursor)
+            entities = q.fetch(size)
+        except (ValueError, db.BadRequestError, db.BadValueError), e:
+            self.response.set_status(400)
+            self.response.headers['Content-Type'] = 'application/json'
+            return self.response.out.write(json.dumps({'error': str(e)}))
+
+        prefetch = set(getattr(self.fields[name], 'prefetch', None)
+                       for name in fields)
+        prefetch.discard(None)
+        if prefetch:
+            prefetch_references(entities, *prefetch)
+        next_cursor = len(entities) == size and q.cursor() or None
+        self.write_items(entities, fields, next_cursor)
+
+    def get_fields(self):
+        names = self.request.get('fields')
+        if not names:
+            return sorted(name for name in self.fields
+                          if name not in self.optional_fields)
+        names = [name.strip() for name in names.split(',') if name.strip()]
+        unknown = [name for name in names if name not in self.fields]
+        if unknown:
+            raise ValueError('unknown field(s) %s' % ', '.join(unknown))
+        return names
+
+    def write_items(self, entities, fields, next_cursor):
+        self.response.headers['Content-Type'] = 'application/json'
+        out = self.response.out
+        out.write('{"items": [')
+        for i, entity in enumerate(entities):
+            if i:
+                out.write(', ')
+            out.write(json.dumps(dict((name, self.fields[name](entity))
+                                      for name in fields)))
+        out.write('], "cursor": %s, "next": %s}' % (
+                json.dumps(next_cursor),
+                json.dumps(next_cursor and self.next_url(next_cursor))))
+
+    def next_url(self, cursor):
+        params = dict((name, value.encode('utf-8'))
+                      for name, value in self.request.GET.items())
+        params['cursor'] = cursor
+        return '%s?%s' % (self.request.path,
+                          urllib.urlencode(sorted(params.items())))
+
+
+POST_FIELDS = {
+    'id': lambda post: post.key().id(),
+    'idea_id': lambda post: key_id(post.root_key),
+    'papa_id': lambda post: key_id(post.papa_key),
+    'author_id': lambda post: key_id(
+        Post.author.get_value_for_datastore(post)),
+    'author': reference(Post, 'author', 'username'),
+    'upvotes': lambda post: post.upvotes,
+    'downvotes': lambda post: post.downvotes,
+    'tags': lambda post: post.tags,
+    'created_at': lambda post: date(post.created_at),
+    'last_modified': lambda post: date(post.last_modified),
+    'body': lambda post: post.body,
+    'url': lambda post: post.make_local_url(),
+    }
+
+IDEA_FIELDS = dict(POST_FIELDS, **{
+    'url': lambda idea: '/idea/%s' % idea.key().id(),
+    'title': lambda idea: idea.title,
+    'stage': lambda idea: idea.stage,
+    'sector_id': lambda idea: key_id(idea.sector_key),
+    'sector': reference(Idea, 'sector', 'name'),
+    'views': lambda idea: idea.views,
+    'local_views': lambda idea: idea.local_views,
+    'reply_count': lambda idea: idea.reply_count,
+    })
+del IDEA_FIELDS['idea_id'], IDEA_FIELDS['papa_id']
+
+
+class IdeasHandler(ApiHandler):
+    model = Idea
+    fields = IDEA_FIELDS
+    filters = {
+        'stage': ('stage', parse_stage),
+        'sector': ('sector', parse_key('Sector')),
+        'tag': ('tags', unicode),
+        'author': ('author', parse_key('Author')),
+        }
+
+
+class PostsHandler(ApiHandler):
+    model = Post
+    fields = POST_FIELDS
+    filters = {
+        'tag': ('tags', unicode),
+        'author': ('author', parse_key('Author')),
+        'idea': ('root', parse_key('Idea')),
+        }
+
+
+class AuthorsHandler(ApiHandler):
+    model = Author
+    fields = {
+        'id': lambda author: author.key().id(),
+        'username': lambda author: author.username,
+        'idea_count': lambda author: author.idea_count,
+        'post_count': lambda author: author.post_count,
+        'contribution_count': lambda author: author.contribution_count,
+        'last_modified': lambda author: date(author.last_modified),
+        }
+
+    def get_query(self):
+        return Author.leaderboard()
+
+
+class SectorsHandler(ApiHandler):
+    model = Sector
+    fields = {
+        'id': lambda sector: sector.key().id(),
+        'name': lambda sector: sector.name,
+        'last_modified': lambda sector: date(sector.last_modified),
+        }
+
+
+urls = [
+    (r'^/api/ideas$', IdeasHandler),
+    (r'^/api/posts$', PostsHandler),
+    (r'^/api/authors$', AuthorsHandler),
+    (r'^/api/sectors$', SectorsHandler),
+    ]
+
+application = webapp.WSGIApplication(urls, debug=True)
+
+def main():
+	run_wsgi_app(application)
+
+if __name__ == '__main__':
+	main()
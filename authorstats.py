@@ -0,0 +1,53 @@
+"""Keeps each Author's idea_count and post_count (and so its stored
+contribution_count) up to date.
+
+Counts are recomputed rather than incremented, so recounting is always safe
+to repeat: the importer defers recount() for the authors in every batch it
+writes, and RecountAuthors recounts everyone.
+"""
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from mapper import Mapper
+from models import Author, Idea, Post, uncache, bump_generation
+
+
+# Counting stops here, which no single author has come close to
+MAX_COUNT = 10000
+
+
+class RecountAuthors(Mapper):
+    KIND = Author
+    BATCH_SIZE = 20
+
+    def map(self, author):
+        return [count_contributions(author)], []
+
+
+def count_contributions(author):
+    """Updates the given author's counts from the datastore, and returns
+    it."""
+    author.idea_count = Idea.all(keys_only=True)\
+        .filter('author =', author.key()).count(MAX_COUNT)
+    author.post_count = Post.all(keys_only=True)\
+        .filter('author =', author.key()).count(MAX_COUNT)
+    return author
+
+def recount(keys):
+    """Recounts the contributions of the authors with the given keys."""
+    authors = [author for author in db.get(keys) if author is not None]
+    db.put([count_contributions(author) for author in authors])
+    uncache(authors)
+    bump_generation()
+
+def defer_recount(entities):
+    """Defers a recount for the authors of any of the given entities."""
+    keys = set()
+    for entity in entities:
+        if isinstance(entity, Post):
+            key = Post.author.get_value_for_datastore(entity)
+            if key is not None:
+                keys.add(key)
+    if keys:
+        deferred.defer(recount, list(keys))
@@ -0,0 +1,236 @@
+#!/usr/bin/env python
+"""
+Runs the importer from the command line, against either the local dev
+datastore or a remote deployment via remote_api, so that bulk imports can
+use a whole machine instead of a single App Engine request.
+
+
+Usage
+-----
+
+Import everything into the local dev datastore:
+
+    python bulkimport.py
+
+Re-import the threads of ideas 1-200 and 350 on production, with 8 workers:
+
+    python bulkimport.py --target production --steps posts \\
+        --ids 1-200,350 --workers 8
+
+Record the pages fetched during an import, then replay them later without
+touching the network (and without writing anything):
+
+    python bulkimport.py --archive pages/
+    python bulkimport.py --archive pages/ --replay --dry-run
+
+Only re-import threads that the refresh scheduler considers due:
+
+    python bulkimport.py --steps posts --incremental
+"""
+
+import datetime
+import optparse
+import sys
+import threading
+import Queue
+
+
+STEPS = ('sectors', 'ideas', 'posts')
+TARGETS = ('local', 'staging', 'production')
+
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--target', choices=TARGETS, default='local',
+                      help='where to import to: %s (default: %%default)' %
+                      ', '.join(TARGETS))
+    parser.add_option('--version', default=None,
+                      help='non-default app version on a remote target')
+    parser.add_option('--steps', default=','.join(STEPS),
+                      help='comma-separated import steps (default: %default)')
+    parser.add_option('--workers', type='int', default=1,
+                      help='threads importing posts (default: %default)')
+    parser.add_option('--batch-size', type='int', default=None,
+                      help='entities per batched put')
+    parser.add_option('--batch-bytes', type='int', default=None,
+                      help='approximate bytes per batched put')
+    parser.add_option('--ids', default=None,
+                      help='idea id ranges to import posts for, e.g. 1-50,72')
+    parser.add_option('--since', default=None,
+                      help='only import posts for ideas created on or after '
+                      'this date (YYYY-MM-DD)')
+    parser.add_option('--incremental', action='store_true', default=False,
+                      help='only import posts for ideas that are due a '
+                      'refresh, and reschedule them afterwards')
+    parser.add_option('--archive', default=None,
+                      help='directory in which to save fetched pages')
+    parser.add_option('--replay', action='store_true', default=False,
+                      help='read pages from --archive instead of fetching')
+    parser.add_option('--dry-run', action='store_true', default=False,
+                      help="parse everything but don't write anything")
+
+    options, args = parser.parse_args(argv)
+    options.steps = [step.strip() for step in options.steps.split(',')]
+    for step in options.steps:
+        if step not in STEPS:
+            parser.error('Unknown step %r' % step)
+    if options.replay and not options.archive:
+        parser.error('--replay requires --archive')
+    if options.ids:
+        try:
+            options.ids = parse_ranges(options.ids)
+        except ValueError:
+            parser.error('Invalid --ids %r' % options.ids)
+    if options.since:
+        try:
+            options.since = datetime.datetime.strptime(
+                options.since, '%Y-%m-%d')
+        except ValueError:
+            parser.error('Invalid --since %r' % options.since)
+    if options.workers < 1:
+        parser.error('--workers must be at least 1')
+    return options
+
+def parse_ranges(s):
+    """Parses a string like '1-50,72' into a list of inclusive (low, high)
+    id ranges."""
+    ranges = []
+    for part in s.split(','):
+        low, sep, high = part.strip().partition('-')
+        low = int(low)
+        high = int(high) if sep else low
+        if high < low:
+            raise ValueError(part)
+        ranges.append((low, high))
+    return ranges
+
+def prep_target(options):
+    """Points the App Engine API stubs at the requested datastore."""
+    import lib.fabric
+    from lib.fabric import utils
+    if options.target == 'local':
+        utils.prep_local_shell()
+    else:
+        getattr(lib.fabric, options.target)(version=options.version)
+        utils.prep_remote_shell(path=lib.fabric.REMOTE_API_PATH)
+
+def select_ideas(options):
+    """Yields the ideas whose threads should be imported.  Their keys are
+    all fetched up front and the ideas got in batches, since a query
+    iterated over the course of a long import may expire."""
+    from google.appengine.ext import db
+    from importer import fetch_keys
+    from models import Idea, RefreshSchedule
+
+    if options.incremental:
+        due = fetch_keys(RefreshSchedule.all(keys_only=True)
+                         .filter('next_refresh <=', datetime.datetime.now()))
+        keys = [db.Key.from_path('Idea', key.name()) for key in due]
+    elif options.ids:
+        keys = ranged_keys(options.ids)
+    else:
+        keys = fetch_keys(Idea.all(keys_only=True))
+    ideas = get_in_batches(keys)
+
+    for idea in ideas:
+        if idea is None:
+            continue
+        if options.ids and not in_ranges(idea.key().id(), options.ids):
+            continue
+        if options.since and idea.created_at < options.since:
+            continue
+        yield idea
+
+def ranged_keys(ranges):
+    from google.appengine.ext import db
+    from importer import fetch_keys
+    from models import Idea
+    keys = []
+    for low, high in ranges:
+        keys.extend(fetch_keys(Idea.all(keys_only=True)
+            .filter('__key__ >=', db.Key.from_path('Idea', low))
+            .filter('__key__ <=', db.Key.from_path('Idea', high))))
+    return keys
+
+def get_in_batches(keys, size=100):
+    from models import Idea
+    batch = []
+    for key in keys:
+        batch.append(key)
+        if len(batch) == size:
+            for idea in Idea.get(batch):
+                yield idea
+            batch = []
+    if batch:
+        for idea in Idea.get(batch):
+            yield idea
+
+def in_ranges(id, ranges):
+    for low, high in ranges:
+        if low <= id <= high:
+            return True
+    return False
+
+def import_posts(options):
+    """Imports the selected threads using a pool of worker threads, each
+    with its own BatchWriter.  Returns the number of entities written."""
+    import importer
+    import scheduler
+
+    commit = not options.dry_run
+    ideas = Queue.Queue(maxsize=options.workers * 2)
+    counts = []
+    errors = []
+
+    def work():
+        writer = importer.BatchWriter(
+            commit, options.batch_size, options.batch_bytes)
+        while True:
+            idea = ideas.get()
+            if idea is None:
+                break
+            try:
+                replies = importer.import_thread(idea, writer)
+                if options.incremental and commit:
+                    writer.flush()
+                    scheduler.reschedule(idea, replies)
+            except Exception, e:
+                print >> sys.stderr, 'Failed to import %s: %s' % (idea, e)
+                errors.append(idea)
+        writer.flush()
+        counts.append(writer.count)
+
+    workers = [threading.Thread(target=work)
+               for i in range(options.workers)]
+    for worker in workers:
+        worker.start()
+    for idea in select_ideas(options):
+        ideas.put(idea)
+    for worker in workers:
+        ideas.put(None)
+    for worker in workers:
+        worker.join()
+
+    if errors:
+        print >> sys.stderr, '%s idea(s) failed' % len(errors)
+    return sum(counts)
+
+def main(argv=None):
+    options = parse_args(argv or sys.argv[1:])
+    prep_target(options)
+
+    import importer
+    if options.archive:
+        importer.archive = importer.Archive(options.archive, options.replay)
+
+    commit = not options.dry_run
+    if 'sectors' in options.steps:
+        importer.import_sectors(commit=commit)
+    if 'ideas' in options.steps:
+        importer.import_ideas(commit=commit)
+    if 'posts' in options.steps:
+        count = import_posts(options)
+        print '%s %s entities' % (commit and 'Wrote' or 'Parsed', count)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Sharded counters for integer properties that are incremented under load.
+
+Increments never touch the datastore directly.  They accumulate as a delta
+in memcache, and the first increment after a flush enqueues a task that
+runs FLUSH_DELAY seconds later.  That task moves the delta into one of
+NUM_SHARDS shard entities, then writes the summed total back onto the
+counted property so that it can still be sorted and filtered on:
+
+    counters.increment(idea, 'local_views')
+
+Deltas that are evicted from memcache before being flushed are lost, which
+is an acceptable trade for counts like page views.
+"""
+
+import logging
+import random
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+from models import uncache
+
+
+NUM_SHARDS = 20
+
+# How long (in seconds) increments are buffered before being flushed
+FLUSH_DELAY = 60
+
+QUEUE_NAME = 'counters'
+FLUSH_URL = '/tasks/counters/flush'
+
+
+class CounterShard(db.Model):
+    """One shard of a counter.  Keyed by '<counter name>#<shard index>'."""
+    count = db.IntegerProperty(default=0, indexed=False)
+
+
+def counter_name(key, prop):
+    return '%s/%s' % (key, prop)
+
+def parse_counter_name(name):
+    key, prop = name.rsplit('/', 1)
+    return db.Key(key), prop
+
+def delta_key(name):
+    return 'counter-delta:%s' % name
+
+def shard_keys(name):
+    return [db.Key.from_path(CounterShard.kind(), '%s#%d' % (name, i))
+            for i in range(NUM_SHARDS)]
+
+def increment(entity_or_key, prop, delta=1):
+    """Increments the given integer property of the given entity, without
+    writing to the datastore."""
+    key = isinstance(entity_or_key, db.Model) and entity_or_key.key() or \
+        entity_or_key
+    name = counter_name(key, prop)
+    value = memcache.incr(delta_key(name), delta, initial_value=0)
+    if value == delta:
+        # First increment since the last flush
+        schedule_flush(name)
+    return value
+
+def schedule_flush(name):
+    # Named tasks make sure only one flush per counter per interval is queued
+    bucket = int(time.time() / FLUSH_DELAY)
+    task_name = 'flush-%s-%s' % (abs(hash(name)), bucket)
+    try:
+        taskqueue.add(url=FLUSH_URL, queue_name=QUEUE_NAME, name=task_name,
+                      params={'name': name}, countdown=FLUSH_DELAY)
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+def flush(name):
+    """Moves the buffered delta for the named counter into a random shard,
+    then stores the counter's total on the counted property."""
+    delta = memcache.get(delta_key(name))
+    if delta:
+        def txn():
+            key = random.choice(shard_keys(name))
+            shard = CounterShard.get(key) or CounterShard(key=key)
+            shard.count += int(delta)
+            shard.put()
+        db.run_in_transaction(txn)
+        remaining = memcache.decr(delta_key(name), int(delta))
+        if remaining:
+            # More increments arrived while we were flushing
+            schedule_flush(name)
+    return store_total(name)
+
+def get_total(name):
+    shards = CounterShard.get(shard_keys(name))
+    return sum(shard.count for shard in shards if shard is not None)
+
+def store_total(name):
+    """Writes the named counter's total onto the property it counts."""
+    key, prop = parse_counter_name(name)
+    total = get_total(name)
+    def txn():
+        entity = db.get(key)
+        if entity is not None and getattr(entity, prop) != total:
+            setattr(entity, prop, total)
+            entity.put()
+            return entity, True
+        return entity, False
+    entity, written = db.run_in_transaction(txn)
+    if entity is None:
+        logging.warning('Counted entity %s no longer exists', key)
+    elif written:
+        uncache([entity])
+    return total
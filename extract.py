@@ -0,0 +1,124 @@
+"""Declarative, single-pass field extraction from BeautifulSoup trees.
+
+An Extractor is built from a list of rules, each of which declares one
+field.  Calling the extractor on an element walks that element's
+descendants exactly once, offering each node to the rules that haven't
+matched yet, and stops as soon as every rule has a value:
+
+    ROW = Extractor(
+        Nth('title', 'a', 0, convert=lambda a: unicode(a.string)),
+        Pattern('views', r'(\d+) Views', convert=int),
+        )
+    fields = ROW(row)  # {'title': u'...', 'views': 12}
+
+Each extractor keeps the cumulative time spent converting each field, so
+the cost of individual fields can be compared with timings().
+"""
+
+import re
+import time
+
+from lib.BeautifulSoup import Tag, NavigableString
+
+
+class ExtractionError(Exception):
+    pass
+
+
+class Rule(object):
+    """Base class for rules.  Subclasses implement match(node, state),
+    returning the matched node (or string) or None; a match is then handed to
+    convert.  state is a dict private to a single extraction, since rules are
+    shared between threads."""
+
+    def __init__(self, name, convert=None, required=True):
+        self.name = name
+        self.convert = convert or (lambda value: value)
+        self.required = required
+
+    def match(self, node, state):
+        raise NotImplementedError
+
+
+class Nth(Rule):
+    """Matches the nth (zero-based) tag with the given name and, optionally,
+    CSS class."""
+
+    def __init__(self, name, tag, n=0, cls=None, **kwargs):
+        super(Nth, self).__init__(name, **kwargs)
+        self.tag = tag
+        self.n = n
+        self.cls = cls
+
+    def match(self, node, state):
+        if not isinstance(node, Tag) or node.name != self.tag:
+            return None
+        if self.cls is not None and \
+                self.cls not in node.get('class', '').split():
+            return None
+        seen = state.get(self, 0)
+        state[self] = seen + 1
+        if seen == self.n:
+            return node
+        return None
+
+
+class Pattern(Rule):
+    """Matches the nth (zero-based, by default the first) text node matching
+    the given regular expression, yielding its first group.  Only text is
+    searched, never markup."""
+
+    def __init__(self, name, pattern, n=0, **kwargs):
+        super(Pattern, self).__init__(name, **kwargs)
+        self.pattern = re.compile(pattern)
+        self.n = n
+
+    def match(self, node, state):
+        if not isinstance(node, NavigableString):
+            return None
+        m = self.pattern.search(node)
+        if not m:
+            return None
+        seen = state.get(self, 0)
+        state[self] = seen + 1
+        if seen == self.n:
+            return m.group(1)
+        return None
+
+
+class Extractor(object):
+
+    def __init__(self, *rules):
+        self.rules = rules
+        self.times = dict((rule.name, 0.0) for rule in rules)
+        self.calls = 0
+
+    def __call__(self, el):
+        self.calls += 1
+        pending = list(self.rules)
+        state = {}
+        values = {}
+        for node in el.recursiveChildGenerator():
+            for rule in list(pending):
+                matched = rule.match(node, state)
+                if matched is not None:
+                    start = time.time()
+                    values[rule.name] = rule.convert(matched)
+                    self.times[rule.name] += time.time() - start
+                    pending.remove(rule)
+            if not pending:
+                break
+
+        for rule in pending:
+            if rule.required:
+                raise ExtractionError('Field %r not found' % rule.name)
+            values[rule.name] = None
+        return values
+
+    def timings(self):
+        """Returns (field name, total seconds, calls) tuples, slowest
+        first."""
+        times = [(name, secs, self.calls)
+                 for name, secs in self.times.iteritems()]
+        times.sort(key=lambda t: t[1], reverse=True)
+        return times
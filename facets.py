@@ -0,0 +1,111 @@
+"""Counts of ideas and posts per stage, sector, tag and author, for the
+facet sidebar on the browse pages.
+
+Nothing is counted per request.  The per-tag, per-stage and per-sector
+counts are the TagStats kept up to date by tagstats.py (whose ALL
+pseudo-tag gives the totals for each stage and sector), and the author
+counts are those kept on each Author by authorstats.py.  get_counts()
+gathers them all into a single document, which is cached until the data
+generation changes.
+"""
+
+import urllib
+
+from google.appengine.api import memcache
+
+from models import Sector, Author, TagStat, STAGES, TAGS, get_generation
+from tagstats import ALL
+
+
+COUNTS_CACHE_TIME = 60 * 60
+
+# How many of the most prolific authors are listed
+TOP_AUTHORS = 10
+
+# The facets, in the order they are shown
+FACETS = ('stage', 'sector', 'tag', 'author')
+
+# The facets that tags are cross-tabulated with, in order of preference
+CROSS_FACETS = ('stage', 'sector')
+
+
+def load_counts():
+    """Builds the counts document from the TagStats, sectors and authors.
+    It maps each kind ('Idea' or 'Post') to a dict of
+    {(tag, facet, value): count}, where tag is ALL for the total and facet
+    and value are None for overall counts, and also lists the sectors and
+    the top authors."""
+    counts = {'Idea': {}, 'Post': {}}
+    for stat in TagStat.all():
+        parts = stat.key().name().split('|')
+        kind, tag = parts[:2]
+        facet, value = len(parts) == 4 and parts[2:] or (None, None)
+        counts.setdefault(kind, {})[(tag, facet, value)] = stat.count
+    sectors = sorted((sector.name, str(sector.key().id()))
+                     for sector in Sector.all())
+    authors = [(author.username, str(author.key().id()),
+                author.contribution_count)
+               for author in Author.leaderboard().fetch(TOP_AUTHORS)]
+    return {'counts': counts, 'sectors': sectors, 'authors': authors}
+
+# The document for the current generation, as last seen by this instance
+_counts = (None, None)
+
+def get_counts():
+    global _counts
+    generation, changed_at = get_generation()
+    if _counts[0] != generation:
+        key = 'facet-counts:%s' % generation
+        doc = memcache.get(key)
+        if doc is None:
+            doc = load_counts()
+            memcache.set(key, doc, time=COUNTS_CACHE_TIME)
+        _counts = (generation, doc)
+    return _counts[1]
+
+def count(doc, tag, facet=None, value=None):
+    """Returns the number of ideas and posts with the given tag (or ALL) in
+    the given stage or sector."""
+    return sum(doc['counts'][kind].get((tag, facet, value), 0)
+               for kind in ('Idea', 'Post'))
+
+def sidebar(filters):
+    """Returns the facet sidebar for a listing with the given filters,
+    which map facet names to the (string) values given in the URL.  The
+    result is a list of (facet, entries) pairs, each entry being a dict
+    with a label, the count and the URL that adds it to the filters.
+
+    Stage and sector counts are narrowed down to the current tag, and tag
+    counts to the current stage (or sector), using the cross-tabulated
+    counts."""
+    doc = get_counts()
+    tag = filters.get('tag', ALL)
+    cross = [(facet, filters[facet]) for facet in CROSS_FACETS
+             if facet in filters][:1] or [(None, None)]
+    cross_facet, cross_value = cross[0]
+
+    choices = {
+        'stage': [(stage, stage, count(doc, tag, 'stage', stage))
+                  for stage in STAGES],
+        'sector': [(name, id, count(doc, tag, 'sector', id))
+                   for name, id in doc['sectors']],
+        'tag': [(t, t, count(doc, t, cross_facet, cross_value))
+                for t in TAGS],
+        'author': doc['authors'],
+        }
+    sections = []
+    for facet in FACETS:
+        entries = [{'label': label, 'count': n,
+                    'url': browse_url(filters, facet, value),
+                    'current': filters.get(facet) == value}
+                   for label, value, n in choices[facet] if n]
+        if entries:
+            sections.append((facet, entries))
+    return sections
+
+def browse_url(filters, facet, value):
+    params = dict(filters)
+    params[facet] = value
+    return '/browse?%s' % urllib.urlencode(
+        sorted((name, unicode(value).encode('utf-8'))
+               for name, value in params.items()))
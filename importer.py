@@ -1,20 +1,76 @@
 import datetime
 import logging
+import os
 import re
 from itertools import takewhile, imap
 from functools import wraps
 
 from google.appengine.api import urlfetch
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 
 from lib.BeautifulSoup import BeautifulSoup, Tag, NavigableString
 from lib import feedparser
-from models import Sector, Author, Post, Idea
-
+from extract import Extractor, Nth, Pattern
+import authorstats
+import summaries
+from models import Sector, Author, Post, Idea, get_cached, uncache
+from models import bump_generation
+from tagstats import TagDeltas, move_thread
+import settings
+
+
+# Pending writes are flushed once this many entities, or approximately this
+# many bytes of encoded entities, have been buffered.
+BATCH_SIZE = 100
+BATCH_BYTES = 512 * 1024
+
+# Fields maintained by this site rather than scraped, which an import must
+# never overwrite with whatever it happened to load earlier
+LOCAL_FIELDS = {
+    'Author': ('idea_count', 'post_count'),
+    'Post': ('tags', 'moved_from'),
+    'Idea': ('tags', 'local_views'),
+    }
+
+
+# If set to an Archive, every page the importer fetches is saved to (or, in
+# replay mode, read back from) disk.
+archive = None
+
+
+class Archive(object):
+    """Stores fetched pages in a directory, one file per URL, so that an
+    import can be re-run later without touching the network."""
+
+    def __init__(self, path, replay=False):
+        self.path = path
+        self.replay = replay
+        if not replay and not os.path.isdir(path):
+            os.makedirs(path)
+
+    def path_for(self, url):
+        return os.path.join(self.path, re.sub(r'[^\w.-]+', '_', url))
+
+    def fetch(self, url):
+        path = self.path_for(url)
+        if self.replay:
+            return open(path, 'rb').read()
+        content = urlfetch.fetch(url).content
+        f = open(path, 'wb')
+        try:
+            f.write(content)
+        finally:
+            f.close()
+        return content
+
+def fetch(url):
+    if archive is not None:
+        return archive.fetch(url)
+    return urlfetch.fetch(url).content
 
 def make_soup(url):
-    html = urlfetch.fetch(url).content
-    return BeautifulSoup(html)
+    return BeautifulSoup(fetch(url))
 
 def withsoup(url):
     def decorator(f):
@@ -35,8 +91,16 @@ def import_sectors(soup, commit=True):
         sector = Sector(key=key, name=link.string.strip())
         sectors.append(sector)
         print u' - %s' % sector
-    if commit:
-        db.put(sectors)
+    # Idea summaries carry sector names, so note which ones changed
+    existing = get_cached([sector.key() for sector in sectors])
+    for sector, old in zip(sectors, existing):
+        sector.renamed = old is None or old.name != sector.name
+    renamed = [sector for sector in sectors if sector.renamed]
+    if commit and renamed:
+        db.put(renamed)
+        uncache(renamed)
+        bump_generation()
+        summaries.defer_rebuild(renamed)
     return sectors
 
 def import_all():
@@ -54,82 +118,230 @@ def import_ideas(soup, commit=True):
         .find('tbody')\
         .findAll('tr', recursive=False)
 
-    ideas = []
-    for i, row in enumerate(rows[:-1]):
-        votes, content = row.findAll('td', recursive=False)
-        raw = unicode(content)
-
-        # Pull out content first
-        title, author, sector = content.findAll('a')[:3]
-        idea_id = find_int(title['href'])
-
-        raw_date = sector.nextSibling
-        created_at = parse_idea_date(raw_date)
-
-        author = make_author(author)
-
-        sector_id = find_int(sector['href'])
-        sector = Sector.get_by_id(sector_id)
-
-        upvotes_el = votes.find('strong')
-        upvotes = find_int(upvotes_el.string.strip())
+    rows = [row.findAll('td', recursive=False) for row in rows[:-1]]
+    rows = [dict(IDEA_VOTES(votes), **IDEA_CONTENT(content))
+            for votes, content in rows]
 
-        downvotes = upvotes_el.nextSibling.nextSibling.nextSibling
-        downvotes = find_int(str(downvotes).strip())
+    # Look up every author at once, so existing authors keep their counts
+    author_keys = [db.Key.from_path('Author', fields['author_id'])
+                   for fields in rows]
+    authors = dict(zip(author_keys, get_cached(author_keys)))
 
-        views = find_int(re.search(r'(\d+) Views', raw).group(1))
-        stage = re.search(r'Stage : (\w+)', raw).group(1)
+    ideas = []
+    changed_authors = {}
+    for fields, author_key in zip(rows, author_keys):
+        author = authors[author_key]
+        if author is None:
+            author = Author(key=author_key, username=fields['author_name'])
+            changed_authors[author_key] = author
+        elif author.username != fields['author_name']:
+            author.renamed = True
+            author.username = fields['author_name']
+            changed_authors[author_key] = author
+        authors[author_key] = author
 
         # Create the idea
-        key = db.Key.from_path('Idea', idea_id)
+        key = db.Key.from_path('Idea', fields['id'])
         idea = Idea(
             key=key,
             author=author,
-            sector=sector,
-            title=unicode(title.string),
-            upvotes=upvotes,
-            downvotes=downvotes,
-            views=views,
-            stage=stage,
-            created_at=created_at,
+            sector=db.Key.from_path('Sector', fields['sector_id']),
+            title=fields['title'],
+            upvotes=fields['upvotes'],
+            downvotes=fields['downvotes'],
+            views=fields['views'],
+            stage=fields['stage'],
+            created_at=fields['created_at'],
             tags=['Idea'])
         ideas.append(idea)
         print ' - %s by %s' % (idea, author)
 
+    # The listing doesn't carry bodies, tags or anything counted locally, so
+    # keep what we already have when re-importing
+    existing = Idea.get([idea.key() for idea in ideas])
+    stats = TagDeltas()
+    moved = []
+    for idea, old in zip(ideas, existing):
+        if old is None:
+            stats.count(idea)
+        else:
+            idea.body = old.body
+            idea.tags = old.tags
+            idea.local_views = old.local_views
+            idea.reply_count = old.reply_count
+            if (old.stage, old.sector_key) != (idea.stage, idea.sector_key):
+                stats.count(old, -1)
+                stats.count(idea)
+                moved.append((idea.key(), old.stage, old.sector_key))
+
     if commit:
-        db.put(ideas)
+        # Only new and renamed authors need writing
+        to_put = changed(changed_authors.values() + ideas)
+        if to_put:
+            db.put(to_put)
+            uncache(to_put)
+            stats.apply()
+            # The ideas' replies count towards their stage and sector too
+            for args in moved:
+                deferred.defer(move_thread, *args)
+            authorstats.defer_recount(to_put)
+            summaries.defer_rebuild(to_put)
+            bump_generation()
+        print 'Wrote %s of %s idea(s)' % (
+            len([e for e in to_put if isinstance(e, Idea)]), len(ideas))
 
     return ideas
 
-def import_posts(commit=True):
-    ideas = Idea.all().fetch(1000)
-    #ideas = [Idea.get_by_id(9)]
-    print 'Importing posts for %s idea(s)...' % len(ideas)
-
-    to_put = []
+def import_posts(ideas=None, commit=True, batch_size=None, batch_bytes=None):
+    """Imports the threads for the given ideas (or every idea), streaming the
+    resulting entities through a BatchWriter so that memory use is bounded
+    by a single idea's thread rather than by the whole corpus.  Returns the
+    number of entities written."""
+    if ideas is None:
+        # Fetch the keys up front, since a query iterated over the course of
+        # a long import may expire
+        keys = fetch_keys(Idea.all(keys_only=True))
+        ideas = (idea for i in range(0, len(keys), 20)
+                 for idea in Idea.get(keys[i:i + 20]) if idea is not None)
+    writer = BatchWriter(commit, batch_size, batch_bytes)
+    print 'Importing posts...'
+
+    count = 0
     for idea in ideas:
-        soup = make_soup(idea.source_url)
-
+        import_thread(idea, writer)
+        count += 1
+    writer.flush()
+
+    print 'Wrote %s entities for %s idea(s)' % (writer.count, count)
+    return writer.count
+
+def fetch_keys(q, batch_size=1000):
+    """Returns every key the given keys-only query matches, a batch at a
+    time with cursors, rather than holding a query open."""
+    keys = []
+    while True:
+        batch = q.fetch(batch_size)
+        keys.extend(batch)
+        if len(batch) < batch_size:
+            return keys
+        q.with_cursor(q.cursor())
+
+def import_thread(idea, writer):
+    """Imports a single idea's body and replies into the given writer,
+    releasing the parsed page as soon as the thread has been walked.
+    Returns the number of replies found in the thread."""
+    soup = make_soup(idea.source_url)
+    replies = 0
+    try:
         # We get the idea's actual body from the RSS feed
-        rss = feedparser.parse(idea_feed_url(idea))
+        rss = feedparser.parse(fetch(idea_feed_url(idea)))
         body = rss.feed.subtitle.replace(
             '\nFeed Created by spigit.com feed manager.', '')
         idea.body = clean_body(body)
-        to_put.append(idea)
+        writer.add([idea])
 
         headers = soup.find('td', 'main')\
             .findAll('div', 'commentheader', recursive=False)
+        siblings = count_comments(headers)
+        matched = set()
         for header in headers:
             content = header.findNextSiblings('div', limit=1)[0]
-            post = make_post(idea, header, content, commit=False)
-            to_put.extend(post)
-
-    to_put = filter(None, to_put)
-
-    if commit:
-        db.put(to_put)
-
-    return to_put
+            entities = make_post(idea, header, content, commit=False,
+                                 stats=writer.stats,
+                                 dry_run=not writer.commit,
+                                 siblings=siblings, matched=matched)
+            replies += len([e for e in entities if isinstance(e, Post)])
+            writer.add(entities)
+        idea.reply_count = replies
+        writer.add([idea])
+    finally:
+        # BeautifulSoup trees are full of reference cycles, so break them up
+        # explicitly instead of waiting on the garbage collector.
+        soup.decompose()
+    return replies
+
+
+class BatchWriter(object):
+    """Buffers entities and writes them with batched puts once either
+    batch_size entities or roughly batch_bytes of encoded entity data are
+    pending.  Entities with the same key are only written once per batch."""
+
+    def __init__(self, commit=True, batch_size=None, batch_bytes=None):
+        self.commit = commit
+        self.batch_size = batch_size or BATCH_SIZE
+        self.batch_bytes = batch_bytes or BATCH_BYTES
+        self.count = 0
+        self.stats = TagDeltas()
+        self.reset()
+
+    def reset(self):
+        self.pending = []
+        self.positions = {}
+        self.pending_bytes = 0
+
+    def add(self, entities):
+        for entity in filter(None, entities):
+            key = entity.has_key() and entity.key() or None
+            if key in self.positions:
+                self.pending[self.positions[key]] = entity
+            else:
+                if key is not None:
+                    self.positions[key] = len(self.pending)
+                self.pending.append(entity)
+            self.pending_bytes += entity_size(entity)
+            if (len(self.pending) >= self.batch_size or
+                self.pending_bytes >= self.batch_bytes):
+                self.flush()
+
+    def flush(self):
+        if self.pending and self.commit:
+            to_put = changed(self.pending)
+            if to_put:
+                db.put(to_put)
+                uncache(to_put)
+                self.stats.apply()
+                authorstats.defer_recount(to_put)
+                summaries.defer_rebuild(to_put)
+                bump_generation()
+            self.count += len(to_put)
+        else:
+            self.count += len(self.pending)
+        self.reset()
+
+def merge_stored(entities):
+    """Re-reads the stored copies of the given entities right before they
+    are written and carries over their LOCAL_FIELDS, so that tag edits and
+    counts made since the entities were loaded aren't reverted.  Returns a
+    dict of the stored copies by key."""
+    keys = [entity.key() for entity in entities if entity.has_key()]
+    stored = dict(zip(keys, db.get(keys)))
+    for entity in entities:
+        old = entity.has_key() and stored.get(entity.key())
+        if old:
+            for name in LOCAL_FIELDS.get(entity.kind(), ()):
+                setattr(entity, name, getattr(old, name))
+    return stored
+
+def changed(entities):
+    """Returns those of the given entities that are new or differ from
+    their stored copies, after merging in the stored copies' local fields,
+    so that re-imports don't rewrite (and re-stamp) unchanged entities."""
+    stored = merge_stored(entities)
+    return [entity for entity in entities
+            if not (entity.has_key() and
+                    same_fields(entity, stored.get(entity.key())))]
+
+def same_fields(entity, old):
+    if old is None:
+        return False
+    for name, prop in entity.properties().iteritems():
+        if name != 'last_modified' and (prop.get_value_for_datastore(entity) !=
+                                        prop.get_value_for_datastore(old)):
+            return False
+    return True
+
+def entity_size(entity):
+    return db.model_to_protobuf(entity).ByteSize()
 
 def sibs(el):
     next = el.nextSibling
@@ -137,74 +349,210 @@ def sibs(el):
         yield next
         next = next.nextSibling
 
-def make_post(parent, header, content, commit=True, level=1):
-    author_link = header.find('span', 'avatarusername').find('a')
-    author = make_author(author_link)
+def make_post(parent, header, content, commit=True, level=1, root=None,
+              stats=None, dry_run=False, siblings=None, matched=None):
+    """Builds the post described by the given comment header and content,
+    along with its replies and authors, and returns them.  New posts are
+    counted into stats, a TagDeltas, if given.  A dry run never touches the
+    datastore's ids, so its posts must not be written.
+
+    siblings is the count_comments() of the comment's siblings on the page,
+    and matched the set of keys of posts already matched to comments in
+    this import, which is updated as posts are matched."""
+    root = root or parent
+    if matched is None:
+        matched = set()
+    fields = COMMENT_HEADER(header)
+    author = make_author(
+        fields['author_id'], fields['author_name'], commit=False)
+    created_at = fields['created_at']
 
     indent = ' ' * (level * 2)
     print '%s- Adding post by %s' % (indent, author)
 
-    created_at = parse_post_date(author_link.parent.nextSibling)
-
     # gather up content elements
     els = iter(content) if content else sibs(header)
     def is_body(el):
         return el.name != 'pre' if isinstance(el, Tag) else True
     body = u'\n'.join(imap(unicode, takewhile(is_body, els)))
 
-    post = Post.all()\
-        .filter('papa =', parent)\
-        .filter('author =', author)\
-        .filter('created_at =', created_at)\
-        .get()
-    if post is None:
-        post = Post(papa=parent, author=author,
-                    created_at=created_at, tags=['Reply'])
-    post.body = clean_body(body)
-
-    to_put = [post]
-
     if content:
         children = content.find('div', style='padding: 5px 0 0 40px;')
     else:
         children = None
 
+    body = clean_body(body)
+    group = settings.THREAD_ENTITY_GROUPS and root.key() or None
+
+    if siblings is None:
+        siblings = count_comments([header])
+    on_page = siblings.get((author.key().id(), created_at.date()), 1)
+    post = find_post(parent, author, created_at, body, group,
+                     on_page=on_page, exclude=matched)
+    if post is not None:
+        matched.add(post.key())
+    else:
+        # Replies need to reference this post, so give it a key up front
+        # instead of writing it ahead of the rest of the batch.
+        if children and dry_run:
+            # Replies can't reference an incomplete key, so use a
+            # placeholder rather than using up a real id
+            location = {'key': db.Key.from_path(
+                    'Post', 'dry-run:%s' % id(header), parent=group)}
+        elif children:
+            location = {'key': allocate_key(Post, group)}
+        else:
+            location = {'parent': group}
+        post = Post(papa=parent, author=author, created_at=created_at,
+                    tags=['Reply'], **location)
+        if stats is not None:
+            stats.count(post, idea=root)
+    post.root = root
+    post.body = body
+
+    to_put = [post]
+    if author.changed:
+        to_put.insert(0, author)
+
     if children:
-        to_put = []
-        post.put()
         headers = children.findAll('div', 'commentheader', recursive=False)
         if headers:
             print '%s  (found %s child post(s))' % (indent, len(headers))
+        replies = count_comments(headers)
         for header in headers:
-            to_put.extend(make_post(post, header, None, level=level+1))
+            to_put.extend(make_post(post, header, None, commit=False,
+                                    level=level+1, root=root, stats=stats,
+                                    dry_run=dry_run, siblings=replies,
+                                    matched=matched))
 
     if commit:
         db.put(to_put)
+        uncache(to_put)
+        bump_generation()
 
     return to_put
 
-def make_author(author_link, commit=True):
-    id = find_int(author_link['href'])
-    username = unicode(author_link.string)
-    key = db.Key.from_path('Author', int(id))
-    author = Author(key=key, username=username)
-    if commit:
+def find_post(papa, author, created_at, body, group=None, on_page=1,
+              exclude=()):
+    """Returns the already imported post matching a comment, or None.
+
+    Comments only carry their date, so a post is identified by its papa,
+    author and day, and by its body if the author replied to the same post
+    more than once that day.  A comment whose body was edited since the
+    last import matches by day alone, but only while the page has no more
+    comments for that papa, author and day (on_page) than are stored, since
+    otherwise it may be a new reply.  Posts whose keys are in exclude have
+    already been matched to another comment.  Posts imported before
+    created_at was date-only carry a time of day, so only the date is
+    compared."""
+    q = Post.all()\
+        .filter('papa =', papa)\
+        .filter('author =', author)
+    if group is not None:
+        q.ancestor(group)
+    stored = [post for post in q.fetch(100)
+              if post.created_at and
+              post.created_at.date() == created_at.date()]
+    candidates = [post for post in stored if post.key() not in exclude]
+    for post in candidates:
+        if post.body == body:
+            return post
+    if candidates and on_page <= len(stored):
+        return candidates[0]
+    return None
+
+def count_comments(headers):
+    """Counts the given comment headers by author id and day."""
+    counts = {}
+    for header in headers:
+        fields = COMMENT_HEADER(header)
+        key = (fields['author_id'], fields['created_at'].date())
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+def allocate_key(model, parent=None):
+    kind = model.kind()
+    start, end = db.allocate_ids(db.Key.from_path(kind, 1, parent=parent), 1)
+    return db.Key.from_path(kind, start, parent=parent)
+
+def make_author(id, username, commit=True):
+    """Returns the author with the given id and username, keeping the counts
+    of an existing author.  The author's changed attribute says whether it
+    is new or renamed, and so needs writing, and renamed whether an existing
+    author was renamed."""
+    key = db.Key.from_path('Author', id)
+    author = get_cached(key)
+    if author is None:
+        author = Author(key=key)
+        author.renamed, author.changed = False, True
+    else:
+        author.renamed = author.changed = author.username != username
+    author.username = username
+    if commit and author.changed:
         author.put()
     return author
 
+INT_RE = re.compile(r'(\d+)')
+
 def find_int(s):
-    return int(re.search(r'(\d+)', s).group(1))
+    return int(INT_RE.search(s).group(1))
+
+IDEA_DATE_RE = re.compile(
+    r'(\d{1,2})/(\d{1,2})/(\d{4}) (\d{1,2}):(\d{2}) ([AP]M)', re.I)
 
 def parse_idea_date(s):
-    s = ' '.join(s.strip().split(' ')[1:-1])
-    return datetime.datetime.strptime(s, '%m/%d/%Y %I:%M %p')
+    """Parses dates like 'on 02/13/2010 04:32 PM PST', ignoring the
+    timezone."""
+    month, day, year, hour, minute, ampm = IDEA_DATE_RE.search(s).groups()
+    hour = int(hour) % 12
+    if ampm.upper() == 'PM':
+        hour += 12
+    return datetime.datetime(
+        int(year), int(month), int(day), hour, int(minute))
+
+POST_DATE_RE = re.compile(r'([A-Za-z]{3})\w* (\d{1,2}), (\d{4})')
+MONTHS = dict((name, i + 1) for i, name in enumerate(
+    ('jan', 'feb', 'mar', 'apr', 'may', 'jun',
+     'jul', 'aug', 'sep', 'oct', 'nov', 'dec')))
 
 def parse_post_date(s):
-    s = s.replace('-', '').strip()
-    now = datetime.datetime.now()
-    date = datetime.datetime.strptime(s, '%b %d, %Y')
-    return date.replace(hour=now.hour, minute=now.minute)
-
+    """Parses dates like '- Feb 13, 2010'.  Posts only carry the date, so
+    the time is midnight, which keeps re-imports of a post identical."""
+    month, day, year = POST_DATE_RE.search(s).groups()
+    return datetime.datetime(int(year), MONTHS[month.lower()], int(day))
+
+
+# Extraction rules for a row of the idea listing, which has a cell with the
+# votes and a cell with the idea's details
+IDEA_VOTES = Extractor(
+    Nth('upvotes', 'strong',
+        convert=lambda el: find_int(el.string)),
+    # The downvotes are the next number in the cell after the upvotes
+    Pattern('downvotes', r'(\d+)', n=1, convert=int),
+    )
+
+IDEA_CONTENT = Extractor(
+    Nth('id', 'a', 0, convert=lambda a: find_int(a['href'])),
+    Nth('title', 'a', 0, convert=lambda a: unicode(a.string)),
+    Nth('author_id', 'a', 1, convert=lambda a: find_int(a['href'])),
+    Nth('author_name', 'a', 1, convert=lambda a: unicode(a.string)),
+    Nth('sector_id', 'a', 2, convert=lambda a: find_int(a['href'])),
+    Nth('created_at', 'a', 2,
+        convert=lambda a: parse_idea_date(a.nextSibling)),
+    Pattern('views', r'(\d+) Views', convert=int),
+    Pattern('stage', r'Stage : (\w+)', convert=unicode),
+    )
+
+# Extraction rules for the header above each comment in a thread
+COMMENT_HEADER = Extractor(
+    Nth('author_id', 'span', cls='avatarusername',
+        convert=lambda span: find_int(span.find('a')['href'])),
+    Nth('author_name', 'span', cls='avatarusername',
+        convert=lambda span: unicode(span.find('a').string)),
+    Nth('created_at', 'span', cls='avatarusername',
+        convert=lambda span: parse_post_date(
+            span.find('a').parent.nextSibling)),
+    )
 
 
 def idea_feed_url(idea):
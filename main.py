@@ -1,17 +1,50 @@
+import hashlib
 import os
 import logging
 import urllib
-from itertools import groupby
-from operator import attrgetter
 
+from google.appengine.api import memcache
 from google.appengine.ext import db
+from google.appengine.ext import deferred
 from google.appengine.ext import webapp
 from google.appengine.ext.webapp import template
 from google.appengine.ext.webapp.util import run_wsgi_app
+from google.appengine.ext.db.stats import KindStat
 
 from django.utils import simplejson as json
 
-from models import Idea, Sector, Author, Post, TAGS, STAGES
+import counters
+import facets
+from pagecache import cache_page, not_modified, content_etag, send_body
+from pagecache import compress, accepts_gzip
+import tagindex
+import tagstats
+import settings
+from models import Idea, Author, Post, TagStat, TAGS, STAGES
+from models import prefetch_references, get_cached, uncache
+from models import bump_generation, get_generation
+from summaries import IdeaSummary, PostSummary, AuthorSummary
+from summaries import PageFetch, InvalidCursorError
+from summaries import get_stage_summaries, summarize
+from summaries import PROJECTION_CACHE_TIME
+
+
+class Page(object):
+    """One page of a paginated listing, with the URLs of its neighbours.
+    fragment_url loads just the next page's items, for "load more"."""
+
+    def __init__(self, items, next_url=None, prev_url=None,
+                 fragment_url=None):
+        self.items = items
+        self.next_url = next_url
+        self.prev_url = prev_url
+        self.fragment_url = fragment_url
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
 
 
 class BaseHandler(webapp.RequestHandler):
@@ -30,27 +63,124 @@ class BaseHandler(webapp.RequestHandler):
         self.response.set_status(200)
         self.response.out.write(template.render(path, local_context))
 
+    def handle_exception(self, exception, debug_mode):
+        if isinstance(exception, InvalidCursorError):
+            # Stale or tampered with
+            self.error(400)
+            for name in ('ETag', 'Last-Modified'):
+                del self.response.headers[name]
+            self.response.headers['Cache-Control'] = 'no-cache'
+            return self.response.out.write('Invalid cursor: %s' % exception)
+        super(BaseHandler, self).handle_exception(exception, debug_mode)
+
+    # The default and largest number of items on one page of a listing
+    page_size = 25
+    max_page_size = 100
+
+    def get_page_size(self):
+        try:
+            size = int(self.request.get('limit') or self.page_size)
+        except ValueError:
+            size = self.page_size
+        return max(1, min(size, self.max_page_size))
+
+    def paginate(self, name, cls, query, param='cursor'):
+        """Returns the Page of summaries of the given query that starts at
+        the cursor given in the named request parameter."""
+        return self.start_pages([(name, cls, query, param)])()[0]
+
+    def start_pages(self, listings):
+        """Starts fetching a Page of summaries for each of the given (name,
+        cls, query, cursor parameter) listings, each starting at the cursor
+        given in its request parameter.  Returns a function that waits for
+        the fetches and returns the Pages, so that other work can be done in
+        the meantime.  A listing whose query is None gets an empty Page.
+
+        Datastore cursors only go forwards, so the cursor each page was
+        reached from is remembered in memcache to link back to it."""
+        size = self.get_page_size()
+        cursors = [self.request.get(param) or None
+                   for name, cls, query, param in listings]
+        fetch = PageFetch([(name, cls, query, cursor, size)
+                           for (name, cls, query, param), cursor
+                           in zip(listings, cursors) if query is not None])
+
+        def join():
+            results = iter(fetch.get_result())
+            pages = []
+            for (name, cls, query, param), cursor in zip(listings, cursors):
+                if query is None:
+                    pages.append(Page([]))
+                    continue
+                items, next_cursor = results.next()
+                page = Page(items)
+                if next_cursor:
+                    memcache.set(prev_cursor_key(next_cursor), cursor or '')
+                    page.next_url = self.page_url(param, next_cursor)
+                    page.fragment_url = self.page_url(param, next_cursor,
+                                                      param)
+                if cursor:
+                    # Fall back to the first page if we've forgotten the way
+                    # back
+                    prev_cursor = memcache.get(prev_cursor_key(cursor))
+                    page.prev_url = self.page_url(param, prev_cursor or None)
+                pages.append(page)
+            return pages
+        return join
+
+    def page_url(self, param, cursor, fragment=None):
+        params = dict((name, value.encode('utf-8')) for name, value
+                      in self.request.GET.items() if name != 'fragment')
+        params.pop(param, None)
+        if cursor:
+            params[param] = cursor
+        if fragment:
+            params['fragment'] = fragment
+        query = urllib.urlencode(sorted(params.items()))
+        return query and '%s?%s' % (self.request.path, query) or \
+            self.request.path
+
+    def write_json(self, obj, cache_control=None):
+        """Writes the given object as JSON, validated by a hash of the
+        output, and answers with a 304 if the client already has it."""
+        body = json.dumps(obj)
+        compressed, gzipped = compress(body)
+        self.response.headers['Content-Type'] = 'application/json'
+        etag = content_etag(body, gzipped and accepts_gzip(self.request))
+        if not not_modified(self, etag, cache_control=cache_control):
+            send_body(self, compressed, gzipped)
+
 
 class IndexHandler(BaseHandler):
 
+    @cache_page
     def get(self):
-        ideas = Idea.all().order('stage').fetch(1000)
-        grouped_ideas = groupby(ideas, attrgetter('stage'))
-        # Force evaluation of the generators, so they can be reused
-        grouped_ideas = [(key, list(group)) for key, group in grouped_ideas]
+        stages = get_stage_summaries(sorted(STAGES), self.page_size)
+        grouped_ideas = [(stage, ideas, total)
+                         for stage, ideas, total in stages if ideas]
         self.render('index.html', {'grouped_ideas': grouped_ideas})
 
 
 class IdeaHandler(BaseHandler):
 
     def get(self, id):
-        idea = Idea.get_by_id(int(id))
+        self.show(id)
+        # Counted here, since show() is skipped when the page is cached
+        if self.response.status in (200, 304):
+            counters.increment(db.Key.from_path('Idea', int(id)),
+                               'local_views')
+
+    @cache_page
+    def show(self, id):
+        idea = get_cached(db.Key.from_path('Idea', int(id)))
         if idea is None:
             self.error(404)
             self.response.out.write('Idea not found.')
             return
 
-        self.render('idea.html', {'idea': idea})
+        prefetch_references([idea], 'author', 'sector')
+        replies = idea.get_replies()
+        self.render('idea.html', {'idea': idea, 'replies': replies})
 
 
 class BrowseHandler(BaseHandler):
@@ -58,25 +188,64 @@ class BrowseHandler(BaseHandler):
     def get_facet(self, facet, criteria):
         return None
 
+    # The queries are started before the facet is looked up, so they must be
+    # built from the criteria alone
+
     def get_ideas(self, facet, criteria):
-        return []
+        """Returns a query for the matching ideas, or None."""
+        return None
 
     def get_posts(self, facet, criteria):
-        return []
+        """Returns a query for the matching posts, or None."""
+        return None
 
-    def get(self, facet, criteria):
-        try:
-            facet = self.get_facet(facet, criteria)
-            ideas = self.get_ideas(facet, criteria)
-            posts = self.get_posts(facet, criteria)
-        except Exception, e:
-            raise
-            logging.error('Could not browse by %s %r: %s', facet, criteria, e)
+    def get_counts(self, facet, criteria):
+        """Returns the total numbers of matching ideas and posts, if they are
+        known without counting the results."""
+        return None, None
+
+    @cache_page
+    def get(self, facet_name, criteria):
+        name = '%s:%s' % (facet_name, criteria)
+        join = self.start_pages([
+            ('ideas:' + name, IdeaSummary,
+             self.get_ideas(facet_name, criteria), 'ideas'),
+            ('posts:' + name, PostSummary,
+             self.get_posts(facet_name, criteria), 'posts'),
+            ])
+        # Look up the facet and counts while the queries run
+        facet = self.get_facet(facet_name, criteria)
+        if facet is None:
             self.error(404)
-            self.response.out.write('%s %s not found.' % (facet, criteria))
-        else:
-            ctx = { 'facet': facet, 'ideas': ideas, 'posts': posts }
-            return self.render('browse.html', ctx)
+            self.response.out.write('%s %s not found.' % (facet_name,
+                                                          criteria))
+            return
+        idea_count, post_count = self.get_counts(facet, criteria)
+        ideas, posts = join()
+        filters = {facet_name: urllib.unquote(criteria)}
+        return self.render_listing(facet, ideas, posts, idea_count,
+                                   post_count, filters)
+
+    def render_listing(self, facet, ideas, posts, idea_count, post_count,
+                       filters):
+        """Renders the listing, or just one of its pages if a fragment was
+        asked for.  filters are the facets it is filtered on, as given in
+        the URL, for the facet sidebar."""
+        pages = {'ideas': ideas, 'posts': posts}
+        fragment = self.request.get('fragment')
+        if fragment in pages:
+            # Just the items, for "load more"
+            return self.render('_%s_page.html' % fragment,
+                               {'page': pages[fragment]})
+        ctx = {
+            'facet': facet,
+            'ideas': ideas,
+            'posts': posts,
+            'idea_count': idea_count,
+            'post_count': post_count,
+            'sidebar': facets.sidebar(filters),
+            }
+        return self.render('browse.html', ctx)
 
     def fake_facet(self, kind, value):
         # Trick the template, which does {{ facet.kind }}: {{ facet }}
@@ -90,48 +259,225 @@ class BrowseHandler(BaseHandler):
 
 class SectorHandler(BrowseHandler):
     def get_facet(self, facet, criteria):
-        return Sector.get_by_id(int(criteria))
+        return get_cached(db.Key.from_path('Sector', int(criteria)))
     def get_ideas(self, facet, criteria):
-        return facet.ideas.fetch(1000)
+        return Idea.all().filter(
+            'sector =', db.Key.from_path('Sector', int(criteria)))
 
 class StageHandler(BrowseHandler):
     def get_facet(self, facet, criteria):
         return self.fake_facet(facet, criteria)
     def get_ideas(self, facet, criteria):
-        return Idea.all().filter('stage =', criteria).fetch(1000)
+        return Idea.all().filter('stage =', criteria)
 
 class AuthorHandler(BrowseHandler):
     def get_facet(self, facet, criteria):
-        return Author.get_by_id(int(criteria))
+        return get_cached(db.Key.from_path('Author', int(criteria)))
     def get_ideas(self, facet, criteria):
-        return Idea.all().filter('author =', facet).fetch(1000)
+        return Idea.all().filter(
+            'author =', db.Key.from_path('Author', int(criteria)))
     def get_posts(self, facet, criteria):
-        return Post.all().filter('author =', facet).fetch(1000)
+        return Post.all().filter(
+            'author =', db.Key.from_path('Author', int(criteria)))
 
 class TagHandler(BrowseHandler):
     def get_facet(self, facet, criteria):
         return self.fake_facet(facet, criteria)
     def get_ideas(self, facet, criteria):
-        return Idea.all().filter('tags =', urllib.unquote(criteria))\
-            .fetch(1000)
+        return Idea.all().filter('tags =', urllib.unquote(criteria))
     def get_posts(self, facet, criteria):
-        return Post.all().filter('tags =', urllib.unquote(criteria))\
-            .fetch(1000)
+        return Post.all().filter('tags =', urllib.unquote(criteria))
+    def get_counts(self, facet, criteria):
+        tag = urllib.unquote(criteria)
+        counts = TagStat.get_counts(('Idea', 'Post'), [tag])
+        return counts[('Idea', tag)], counts[('Post', tag)]
+
+
+class FilterHandler(BrowseHandler):
+    """Browses the ideas and posts matching any combination of facets, e.g.
+    /browse?stage=Validation&tag=Disagreement&sector=3.
+
+    Every facet is an equality filter, so each listing is a single keys-only
+    query that the datastore answers with a merge join, without needing a
+    composite index per combination.  Posts don't carry their idea's stage
+    or sector, so those filters are applied to posts by intersecting their
+    roots with the matching ideas' keys in memory.  The matching
+    keys (up to max_matches per listing, with the count shown as a lower
+    bound past that) are cached, and only the entities on the pages shown
+    are fetched."""
+
+    facet_names = ('stage', 'sector', 'tag', 'author')
+    max_matches = 1000
+
+    @cache_page
+    def get(self):
+        try:
+            filters = self.get_filters()
+        except ValueError, e:
+            self.error(400)
+            return self.response.out.write('Invalid filter: %s' % e)
+        if not filters:
+            return self.redirect('/')
+
+        refs = [filters[name] for name in ('sector', 'author')
+                if name in filters]
+        if refs and None in get_cached(refs):
+            self.error(404)
+            return self.response.out.write('No such sector or author.')
+
+        idea_keys, ideas_truncated, post_keys, posts_truncated = \
+            find_matches(filters, self.max_matches)
+        ideas = self.get_key_page(idea_keys, 'ideas')
+        posts = self.get_key_page(post_keys, 'posts')
+
+        # Fetch both pages' entities, and their references, in one go
+        entities = get_cached(ideas.items + posts.items)
+        idea_entities = filter(None, entities[:len(ideas.items)])
+        post_entities = filter(None, entities[len(ideas.items):])
+        summaries = summarize(idea_entities + post_entities)
+        ideas.items = summaries[:len(idea_entities)]
+        posts.items = summaries[len(idea_entities):]
+
+        facet = self.fake_facet('browse', self.describe(filters))
+        return self.render_listing(
+            facet, ideas, posts,
+            self.count_label(idea_keys, ideas_truncated),
+            self.count_label(post_keys, posts_truncated),
+            dict((name, self.request.get(name).strip()) for name in filters))
+
+    def count_label(self, keys, truncated):
+        """Returns the number of matches to show, which is only a lower
+        bound if the matches were cut short."""
+        if truncated:
+            return u'%s+' % len(keys)
+        return len(keys)
+
+    def get_filters(self):
+        """Returns the facet filters given in the request, mapped to the
+        values they compare against."""
+        filters = {}
+        for name in self.facet_names:
+            value = self.request.get(name).strip()
+            if not value:
+                continue
+            if name == 'stage' and value not in STAGES:
+                raise ValueError('unknown stage %r' % value)
+            elif name == 'sector':
+                value = db.Key.from_path('Sector', int(value))
+            elif name == 'author':
+                value = db.Key.from_path('Author', int(value))
+            filters[name] = value
+        return filters
+
+    def get_key_page(self, keys, param):
+        """Returns a Page of the given keys, from the offset given in the
+        named request parameter."""
+        size = self.get_page_size()
+        try:
+            offset = max(0, int(self.request.get(param) or 0))
+        except ValueError:
+            offset = 0
+        page = Page(keys[offset:offset + size])
+        if offset + size < len(keys):
+            page.next_url = self.page_url(param, str(offset + size))
+            page.fragment_url = self.page_url(param, str(offset + size),
+                                              param)
+        if offset:
+            page.prev_url = self.page_url(param,
+                                          str(max(0, offset - size)))
+        return page
+
+    def describe(self, filters):
+        names = {'sector': lambda key: get_cached(key).name,
+                 'author': lambda key: get_cached(key).username}
+        return u', '.join(u'%s %s' % (name, names.get(name, unicode)(
+                    filters[name])) for name in self.facet_names
+                          if name in filters)
+
+
+def find_matches(filters, limit):
+    """Returns the keys of the ideas and of the posts that match the given
+    facet filters, at most limit of each, and whether either listing was
+    cut short, as (idea_keys, ideas_truncated, post_keys, posts_truncated).
+    Results are cached until the data generation changes."""
+    generation, changed_at = get_generation()
+    digest = hashlib.md5(repr(sorted(filters.items()))).hexdigest()
+    cache_key = 'matches:%s:%s' % (generation, digest)
+    matches = memcache.get(cache_key)
+    if matches is not None:
+        return matches
+
+    def query(model, names, keys_only=True):
+        q = model.all(keys_only=keys_only)
+        for name in names:
+            q.filter('%s =' % (name == 'tag' and 'tags' or name),
+                     filters[name])
+        return q
+
+    idea_facets = [name for name in ('stage', 'sector') if name in filters]
+    post_facets = [name for name in ('tag', 'author') if name in filters]
+    # One more than the limit is fetched to tell whether there were more
+    ideas = query(Idea, filters.keys()).run(
+        limit=limit + 1, batch_size=limit + 1)
+    post_keys = []
+    # Listing every post in a stage or sector isn't useful
+    if post_facets and idea_facets:
+        # Posts don't store their idea's stage or sector, so they are
+        # matched against every matching idea through their root, paging
+        # through the posts until enough have matched.  Grouped posts'
+        # roots are their parents, so their keys are enough.
+        grouped = settings.THREAD_ENTITY_GROUPS
+        threads = set(query(Idea, idea_facets).run(batch_size=1000))
+        for post in query(Post, post_facets, keys_only=grouped).run(
+                batch_size=limit + 1):
+            if grouped:
+                key, root = post, post.parent()
+            else:
+                key, root = post.key(), post.root_key
+            if root in threads:
+                post_keys.append(key)
+                if len(post_keys) > limit:
+                    break
+    elif post_facets:
+        post_keys = list(query(Post, post_facets).run(
+                limit=limit + 1, batch_size=limit + 1))
+
+    idea_keys = list(ideas)
+    matches = (idea_keys[:limit], len(idea_keys) > limit,
+               post_keys[:limit], len(post_keys) > limit)
+    memcache.set(cache_key, matches, time=PROJECTION_CACHE_TIME)
+    return matches
 
 
 class TagsHandler(BaseHandler):
     """Handles the tag-completion choices on GET and updates the tags on
     arbitrary items on POST."""
 
+    completion_limit = 10
+
     def get(self, path=None):
         # Special case for tag completion choices
         if 'q' in self.request.params and not path:
-            q = self.request.params.get('q').strip()
-            matches = [tag for tag in TAGS if q.lower() in tag.lower()]
+            q = self.request.params.get('q')
+            matches = tagindex.complete(q, self.completion_limit)
             resp = [{'id': match, 'name': match} for match in matches]
-            self.response.headers['Content-Type'] = 'application/json'
-            self.response.out.write(json.dumps(resp))
-            return
+            # The choices are the same for everyone, and their order only
+            # drifts slowly as tags are used
+            return self.write_json(resp, 'public, max-age=3600')
+
+        # Otherwise, show the tag cloud
+        self.show_cloud()
+
+    @cache_page
+    def show_cloud(self):
+        counts = TagStat.get_counts(('Idea', 'Post'), TAGS)
+        cloud = [(tag, counts[('Idea', tag)], counts[('Post', tag)])
+                 for tag in TAGS]
+        most = max([ideas + posts for tag, ideas, posts in cloud] + [1])
+        cloud = [{'tag': tag, 'ideas': ideas, 'posts': posts,
+                  'size': 1 + 4 * (ideas + posts) / most}
+                 for tag, ideas, posts in cloud]
+        self.render('tags.html', {'cloud': cloud})
 
     def post(self, path=None):
         key = self.request.POST.get('key')
@@ -155,24 +501,167 @@ class TagsHandler(BaseHandler):
             if obj is None:
                 self.error(500)
                 return self.response.out.write('Entity %r not found' % key)
+            old_tags = list(obj.tags)
             obj.tags = tags
             obj.put()
+            deferred.defer(tagstats.record_change, obj.key(), old_tags, tags,
+                           _transactional=True)
             return obj
         obj = db.run_in_transaction(txn)
+        if obj is None:
+            return
+        uncache([obj])
+        bump_generation()
 
-        self.response.headers['Content-Type'] = 'application/json'
-        self.response.out.write(json.dumps(obj.tags))
+        self.write_json(obj.tags)
+
+
+class BulkTagsHandler(BaseHandler):
+    """Changes the tags on many items in one request.  Takes a JSON body
+    that either gives each item's new tags:
+
+        {"changes": [{"key": "...", "tags": ["Agreement", "Sourcing"]}, ...]}
+
+    or adds and/or removes tags on a list of items:
+
+        {"keys": ["...", ...], "add": ["Agreement"], "remove": ["Spam"]}
+
+    Items in the same entity group are updated in a single transaction, and
+    items given more than once are left alone.  Responds with a JSON object
+    mapping each key to either its new tags or an error."""
+
+    max_keys = 500
+
+    def post(self):
+        try:
+            data = json.loads(self.request.body)
+            if 'changes' in data:
+                changes = [(change['key'], valid_tags(change['tags']),
+                            None, None) for change in data['changes']]
+            else:
+                add = valid_tags(data.get('add', []))
+                remove = valid_tags(data.get('remove', []))
+                changes = [(key, None, add, remove) for key in data['keys']]
+            for change in changes:
+                if not isinstance(change[0], basestring):
+                    raise TypeError('Keys must be given as strings')
+        except (ValueError, TypeError, KeyError, AttributeError), e:
+            self.error(400)
+            return self.response.out.write('Invalid request: %s' % e)
+        if len(changes) > self.max_keys:
+            self.error(400)
+            return self.response.out.write(
+                'At most %s items may be changed at once' % self.max_keys)
+
+        results = {}
+        groups = {}
+        seen = {}
+        for change in changes:
+            try:
+                key = db.Key(change[0])
+            except (db.BadKeyError, db.BadArgumentError):
+                results[change[0]] = {'error': 'Invalid key'}
+                continue
+            if key.kind() not in (Idea.kind(), Post.kind()):
+                results[change[0]] = {'error': 'Item cannot be tagged'}
+                continue
+            seen[key] = seen.get(key, 0) + 1
+            groups.setdefault(entity_group(key), []).append(
+                (key,) + change[1:])
+
+        # An item given more than once would have its changes counted twice
+        # (or contradict itself), so it isn't changed at all
+        for group in groups.keys():
+            groups[group] = [change for change in groups[group]
+                             if seen[change[0]] == 1]
+            if not groups[group]:
+                del groups[group]
+        for key, count in seen.iteritems():
+            if count > 1:
+                results[str(key)] = {'error': 'Item given more than once'}
+
+        changed = []
+        for group, group_changes in groups.iteritems():
+            # A failed group mustn't lose the groups already written
+            try:
+                entities = db.run_in_transaction(retag, group_changes)
+            except db.Error, e:
+                logging.warning('Could not retag %s: %r', group, e)
+                for change in group_changes:
+                    results[str(change[0])] = {
+                        'error': 'Could not save, please try again'}
+                continue
+            for (key, tags, add, remove), entity in \
+                    zip(group_changes, entities):
+                if entity is None:
+                    results[str(key)] = {'error': 'Item not found'}
+                else:
+                    results[str(key)] = {'tags': entity.tags}
+                    changed.append(entity)
+        if changed:
+            uncache(changed)
+            bump_generation()
+
+        self.write_json(results)
+
+
+def valid_tags(tags):
+    if not isinstance(tags, list):
+        raise TypeError('Tags must be given as a list')
+    return [tag.strip() for tag in tags if tag.strip() in TAGS]
+
+def entity_group(key):
+    while key.parent() is not None:
+        key = key.parent()
+    return key
+
+def retag(changes):
+    """Applies the given (key, tags, tags to add, tags to remove) changes,
+    which must all be in one entity group, inside a transaction.  Returns
+    the changed entities, with None for any that don't exist."""
+    entities = db.get([key for key, tags, add, remove in changes])
+    to_put, counted = [], []
+    for entity, (key, tags, add, remove) in zip(entities, changes):
+        if entity is None:
+            continue
+        old_tags = list(entity.tags)
+        if tags is None:
+            tags = [tag for tag in old_tags if tag not in remove] + \
+                [tag for tag in add if tag not in old_tags]
+        if tags != old_tags:
+            entity.tags = tags
+            to_put.append(entity)
+            counted.append((key, old_tags, tags))
+    if to_put:
+        db.put(to_put)
+        # A single task, since transactions may only enqueue a few
+        deferred.defer(tagstats.record_changes, counted, _transactional=True)
+    return entities
 
 
 class AuthorsHandler(BaseHandler):
+
+    page_size = 50
+
+    @cache_page
     def get(self):
-        def sorter(author):
-            return (author.contribution_count,
-                    author.idea_count,
-                    author.post_count)
-        authors = Author.all().fetch(1000)
-        authors.sort(key=sorter, reverse=True)
-        return self.render('authors.html', {'authors': authors})
+        ctx = {
+            'authors': self.paginate('authors', AuthorSummary,
+                                     Author.leaderboard()),
+            'total': count_kind('Author'),
+            }
+        return self.render('authors.html', ctx)
+
+
+def prev_cursor_key(cursor):
+    return 'prev-cursor:%s' % hashlib.md5(cursor).hexdigest()
+
+def count_kind(kind):
+    """Returns the number of entities of the given kind according to the
+    datastore statistics, which are updated about once a day, or None if no
+    statistics are available yet."""
+    stat = KindStat.all().filter('kind_name =', kind).get()
+    return stat and stat.count
 
 
 urls = [
@@ -183,7 +672,9 @@ urls = [
     (r'^/(author)/(\d+)', AuthorHandler),
     (r'^/authors$', AuthorsHandler),
     (r'^/(tag)/(.+)', TagHandler),
+    (r'^/browse$', FilterHandler),
     (r'^/tags$', TagsHandler),
+    (r'^/tags/bulk$', BulkTagsHandler),
     ]
 
 application = webapp.WSGIApplication(urls, debug=True)
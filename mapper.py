@@ -0,0 +1,174 @@
+"""A small framework for mapping a function over every entity of a kind, for
+schema migrations and backfills.
+
+Subclass Mapper, set KIND (and optionally FILTERS), and implement map(),
+which returns the entities to put and the keys (or entities) to delete:
+
+    class TouchIdeas(Mapper):
+        KIND = Idea
+        def map(self, idea):
+            return [idea], []
+
+    TouchIdeas().start()
+
+start() splits the kind into SHARDS key ranges using the __scatter__
+property and defers a task per range.  Each task handles one batch of
+BATCH_SIZE entities, writes the results with batched puts and deletes,
+checkpoints its query cursor in a MapperState entity, and defers the next
+batch.  If a shard stops (e.g. after an error was fixed), resume() picks
+every unfinished shard back up from its last checkpoint.  Batches may be
+re-run after a failure, so map() must be idempotent.
+"""
+
+import logging
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from models import uncache, bump_generation
+
+
+class MapperState(db.Model):
+    """The progress of one shard of a mapper run.  Keyed by
+    '<mapper name>:<shard index>'."""
+    shards = db.IntegerProperty()
+    low = db.TextProperty()
+    high = db.TextProperty()
+    cursor = db.TextProperty()
+    count = db.IntegerProperty(default=0)
+    done = db.BooleanProperty(default=False)
+    # Only used on shard 0, to make sure finish() is only called once
+    finished = db.BooleanProperty(default=False)
+    updated_at = db.DateTimeProperty(auto_now=True)
+
+
+class Mapper(object):
+
+    # The model to map over
+    KIND = None
+
+    # (filter, value) pairs restricting the entities mapped over.  Only
+    # equality filters may be used, since shards are split on key ranges.
+    FILTERS = ()
+
+    BATCH_SIZE = 100
+    SHARDS = 8
+
+    def __init__(self, kind=None):
+        if kind is not None:
+            self.KIND = kind
+
+    @property
+    def name(self):
+        return '%s-%s' % (self.__class__.__name__, self.KIND.kind())
+
+    def map(self, entity):
+        """Returns a tuple of (entities to put, keys to delete) for the given
+        entity."""
+        return [], []
+
+    def batch_done(self, shard, cursor):
+        """Called after each batch has been written, with the shard and the
+        cursor the batch started from, which identify the batch if it is
+        re-run."""
+        pass
+
+    def finish(self):
+        """Called once, when every shard has finished."""
+        pass
+
+    def get_query(self, low=None, high=None):
+        q = self.KIND.all()
+        for prop, value in self.FILTERS:
+            q.filter(prop, value)
+        if low is not None:
+            q.filter('__key__ >=', low)
+        if high is not None:
+            q.filter('__key__ <', high)
+        return q
+
+    def split(self, shards):
+        """Returns (low, high) key ranges that roughly evenly divide the kind,
+        sampled from the __scatter__ property."""
+        sample = db.Query(self.KIND, keys_only=True)\
+            .order('__scatter__')\
+            .fetch(shards * 8)
+        sample.sort()
+        points = [sample[i * len(sample) / shards] for i in range(1, shards)
+                  if sample]
+        bounds = [None] + sorted(set(points)) + [None]
+        return zip(bounds[:-1], bounds[1:])
+
+    def state_key(self, shard):
+        name = '%s:%d' % (self.name, shard)
+        return db.Key.from_path(MapperState.kind(), name)
+
+    def start(self, shards=None):
+        """Starts mapping over every entity from scratch."""
+        ranges = self.split(shards or self.SHARDS)
+        states = [MapperState(key=self.state_key(shard), shards=len(ranges),
+                              low=low and str(low), high=high and str(high))
+                  for shard, (low, high) in enumerate(ranges)]
+        db.put(states)
+        logging.info('Starting %s with %s shard(s)', self.name, len(states))
+        for shard in range(len(states)):
+            deferred.defer(self.run_batch, shard)
+
+    def resume(self):
+        """Restarts every unfinished shard from its last checkpoint."""
+        for shard, state in enumerate(self.get_states()):
+            if not state.done:
+                deferred.defer(self.run_batch, shard)
+
+    def get_states(self):
+        first = MapperState.get(self.state_key(0))
+        if first is None:
+            return []
+        return [first] + MapperState.get(
+            [self.state_key(i) for i in range(1, first.shards)])
+
+    def run_batch(self, shard):
+        state = MapperState.get(self.state_key(shard))
+        if state is None or state.done:
+            return
+
+        q = self.get_query(state.low and db.Key(state.low),
+                           state.high and db.Key(state.high))
+        if state.cursor:
+            q.with_cursor(state.cursor)
+        entities = q.fetch(self.BATCH_SIZE)
+
+        to_put, to_delete = [], []
+        for entity in entities:
+            puts, deletes = self.map(entity)
+            to_put.extend(puts)
+            to_delete.extend(deletes)
+        if to_put:
+            db.put(to_put)
+        if to_delete:
+            db.delete(to_delete)
+        if to_put or to_delete:
+            uncache(to_put + to_delete)
+            bump_generation()
+        self.batch_done(shard, state.cursor)
+
+        state.cursor = q.cursor()
+        state.count += len(entities)
+        state.done = len(entities) < self.BATCH_SIZE
+        state.put()
+
+        if not state.done:
+            deferred.defer(self.run_batch, shard)
+        elif all(s.done for s in self.get_states()):
+            if db.run_in_transaction(self.mark_finished):
+                logging.info('Finished %s', self.name)
+                self.finish()
+
+    def mark_finished(self):
+        """Flags the run as finished, returning False if it already was."""
+        first = MapperState.get(self.state_key(0))
+        if first.finished:
+            return False
+        first.finished = True
+        first.put()
+        return True
@@ -0,0 +1,118 @@
+"""One-off data migrations, usually started from a `fab shell`.  Each
+runs as a Mapper (see mapper.py), so it can be resumed if it fails.
+"""
+
+import logging
+
+from google.appengine.ext import db
+
+from mapper import Mapper
+from models import Post, Idea, uncache
+
+
+class GroupThreads(Mapper):
+    """Moves every idea's thread into the idea's entity group.  Run this
+    before turning on settings.THREAD_ENTITY_GROUPS: ungrouped imports still
+    find posts that have been moved, but grouped imports would not find posts
+    that haven't."""
+    KIND = Idea
+    BATCH_SIZE = 10
+
+    def map(self, idea):
+        # Each thread is copied in its own transaction, and the originals
+        # are deleted (and uncached) along with the rest of the batch
+        return [], group_thread(idea)
+
+
+class SetRoots(Mapper):
+    """Stores the root idea on every post."""
+    KIND = Idea
+    BATCH_SIZE = 20
+
+    def map(self, idea):
+        return set_roots(idea), []
+
+
+class StampModified(Mapper):
+    """Re-puts every entity of a kind, so that entities stored before
+    BaseModel.last_modified existed get stamped and show up in
+    changed_since() queries.  Takes the kind to map over:
+
+        StampModified(Author).start()
+    """
+    BATCH_SIZE = 50
+
+    def map(self, entity):
+        return [entity], []
+
+
+def group_thread(idea):
+    """Re-creates every post in the given idea's thread as a child of the
+    idea, remaps their papa references to the new keys, and returns the
+    keys of the originals, which are left for the caller to delete.  Each
+    copy records the key it was copied from, so originals that were already
+    copied (e.g. by a run that failed before deleting them) aren't copied
+    again.  Posts that are already in the group are otherwise left alone, so
+    this is safe to re-run."""
+    posts = walk_thread(idea)
+    grouped = [post for post in posts if post.key().parent() == idea.key()]
+    originals = [post for post in posts if post.key().parent() != idea.key()]
+    if not originals:
+        return []
+
+    # Originals that were already copied keep the key of their copy
+    new_keys = dict((db.Key(post.moved_from), post.key())
+                    for post in grouped if post.moved_from)
+    moving = [post for post in originals if post.key() not in new_keys]
+    logging.info('Moving %s post(s) into idea %s', len(moving), idea.key())
+
+    # Allocate the new keys first, so that references can be remapped
+    if moving:
+        start, end = db.allocate_ids(
+            db.Key.from_path('Post', 1, parent=idea.key()), len(moving))
+        new_keys.update(
+            (post.key(), db.Key.from_path('Post', id, parent=idea.key()))
+            for post, id in zip(moving, range(start, end + 1)))
+
+    to_put = []
+    for post in moving + grouped:
+        papa = new_keys.get(post.papa_key)
+        if post.key().parent() != idea.key():
+            props = dict((name, prop.get_value_for_datastore(post))
+                         for name, prop in post.properties().iteritems())
+            props['papa'] = papa or props['papa']
+            props['root'] = idea.key()
+            props['moved_from'] = str(post.key())
+            to_put.append(Post(key=new_keys[post.key()], **props))
+        elif papa is not None:
+            # Already grouped, but replying to a post that is being moved
+            post.papa = papa
+            to_put.append(post)
+
+    # Everything being written is in the idea's entity group, so the new
+    # thread appears all at once
+    if to_put:
+        db.run_in_transaction(db.put, to_put)
+        uncache(to_put)
+    return [post.key() for post in originals]
+
+def set_roots(idea):
+    """Returns the posts in the given idea's thread that don't yet have it
+    as their root, with it set."""
+    posts = [post for post in walk_thread(idea)
+             if Post.root.get_value_for_datastore(post) != idea.key()]
+    for post in posts:
+        post.root = idea
+    return posts
+
+def walk_thread(idea):
+    """Returns every post in the given idea's thread by walking the papa
+    references breadth-first, for threads that can't yet be loaded with
+    Idea.thread()."""
+    posts = []
+    frontier = [idea.key()]
+    while frontier:
+        children = Post.all().filter('papa IN', frontier[:30]).fetch(1000)
+        frontier = frontier[30:] + [post.key() for post in children]
+        posts.extend(children)
+    return posts
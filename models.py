@@ -1,6 +1,11 @@
+import datetime
 import logging
+from google.appengine.api import memcache
+from google.appengine.datastore import entity_pb
 from google.appengine.ext import db
 
+import settings
+
 
 STAGES = ('Incubation', 'Validation', 'Emergence', 'Closed', 'Aborted')
 
@@ -25,10 +30,196 @@ TAGS = ('Idea',
         'Spam')
 
 
+def prefetch_references(entities, *names):
+    """Resolves the named ReferenceProperty attributes on each of the given
+    entities with a single batched db.get, so that touching them afterwards
+    (e.g. in a template) costs no further datastore round trips.  Returns the
+    entities."""
+    fields = []
+    for entity in entities:
+        props = entity.properties()
+        for name in names:
+            prop = props.get(name)
+            if prop is not None:
+                key = prop.get_value_for_datastore(entity)
+                if key is not None:
+                    fields.append((entity, prop, key))
+
+    keys = list(set(key for entity, prop, key in fields))
+    referents = dict(zip(keys, get_cached(keys)))
+    for entity, prop, key in fields:
+        if referents[key] is not None:
+            prop.__set__(entity, referents[key])
+    return entities
+
+
+class DerivedProperty(db.Property):
+    """A read-only property whose value is computed from the rest of the
+    entity by derive(entity).  The computed value is stored on every write,
+    so it can be indexed, filtered and sorted on like any other property."""
+
+    def __init__(self, derive, *args, **kwargs):
+        super(DerivedProperty, self).__init__(*args, **kwargs)
+        self.derive = derive
+
+    def __get__(self, model_instance, model_class):
+        if model_instance is None:
+            return self
+        return self.derive(model_instance)
+
+    def __set__(self, model_instance, value):
+        # Stored values are ignored in favour of deriving them afresh
+        pass
+
+
+# How long (in seconds) cached entities live in memcache
+ENTITY_CACHE_TIME = 24 * 60 * 60
+
+def get_cached(keys):
+    """Like db.get, but reads entities whose model has cached set from
+    memcache where possible, filling memcache from the datastore on a miss.
+    Accepts a single key or a list of keys."""
+    multiple = isinstance(keys, (list, tuple))
+    if not multiple:
+        keys = [keys]
+    elif not keys:
+        return []
+    keys = [isinstance(key, basestring) and db.Key(key) or key
+            for key in keys]
+
+    cacheable = [key for key in keys if is_cached_kind(key.kind())]
+    found = {}
+    if cacheable:
+        cached = memcache.get_multi(map(cache_key, cacheable))
+        for key in cacheable:
+            data = cached.get(cache_key(key))
+            if data is not None:
+                found[key] = db.model_from_protobuf(entity_pb.EntityProto(data))
+
+    missing = [key for key in keys if key not in found]
+    if missing:
+        entities = db.get(missing)
+        to_cache = {}
+        for key, entity in zip(missing, entities):
+            found[key] = entity
+            if entity is not None and entity.cached:
+                to_cache[cache_key(key)] = \
+                    db.model_to_protobuf(entity).Encode()
+        if to_cache:
+            memcache.set_multi(to_cache, time=ENTITY_CACHE_TIME)
+
+    results = [found[key] for key in keys]
+    if multiple:
+        return results
+    return results[0]
+
+def uncache(entities_or_keys):
+    """Drops the given entities (or keys) from the entity cache.  Must be
+    called after any write that doesn't go through BaseModel.put(), and
+    after any transaction has committed."""
+    keys = [isinstance(obj, db.Model) and obj.key() or obj
+            for obj in entities_or_keys]
+    keys = [key for key in keys if is_cached_kind(key.kind())]
+    if keys:
+        memcache.delete_multi(map(cache_key, keys))
+
+def cache_key(key):
+    return 'entity:%s' % key
+
+def is_cached_kind(kind):
+    try:
+        return db.class_for_kind(kind).cached
+    except (db.KindError, AttributeError):
+        return False
+
+
+class Generation(db.Model):
+    """A single, global counter that is bumped whenever the site's data
+    changes, so that caches and validators can be keyed on it.  The live
+    count is kept in memcache, and only saved here every SAVE_EVERY bumps,
+    to seed it again if it is evicted.  See get_generation() and
+    bump_generation()."""
+    number = db.IntegerProperty(default=0, indexed=False)
+    changed_at = db.DateTimeProperty(indexed=False)
+
+    # How many bumps may go unsaved
+    SAVE_EVERY = 100
+
+GENERATION_KEY = 'generation'
+GENERATION_TIME_KEY = 'generation-time'
+
+def get_generation():
+    """Returns the current (generation number, time of change) pair."""
+    values = memcache.get_multi([GENERATION_KEY, GENERATION_TIME_KEY])
+    number = values.get(GENERATION_KEY)
+    if number is None:
+        return seed_generation()
+    return number, values.get(GENERATION_TIME_KEY)
+
+def seed_generation():
+    """Restores the generation in memcache from the last saved one.  Up to
+    SAVE_EVERY bumps may have gone unsaved, so it is moved past them, which
+    keeps it from ever repeating a number."""
+    gen = Generation.get_by_key_name(GENERATION_KEY) or \
+        Generation(key_name=GENERATION_KEY)
+    number = gen.number + Generation.SAVE_EVERY
+    if memcache.add(GENERATION_KEY, number):
+        memcache.set(GENERATION_TIME_KEY, gen.changed_at)
+        save_generation(number, gen.changed_at)
+        return number, gen.changed_at
+    # Someone else got there first
+    return get_generation()
+
+def save_generation(number, changed_at):
+    try:
+        Generation(key_name=GENERATION_KEY, number=number,
+                   changed_at=changed_at).put()
+    except db.Error, e:
+        logging.warning('Could not save generation %s: %s', number, e)
+
+def bump_generation():
+    """Records that the site's data has changed, returning the new
+    generation number.  This only touches memcache (and the datastore
+    every SAVE_EVERY bumps), so it is cheap enough for every writer."""
+    number = memcache.incr(GENERATION_KEY)
+    if number is None:
+        seed_generation()
+        number = memcache.incr(GENERATION_KEY)
+        if number is None:
+            logging.warning('Could not bump the generation')
+            return None
+    changed_at = datetime.datetime.now()
+    memcache.set(GENERATION_TIME_KEY, changed_at)
+    if number % Generation.SAVE_EVERY == 0:
+        save_generation(number, changed_at)
+    return number
+
+
 class BaseModel(db.Model):
 
     host = 'http://manorlabs.spigit.com'
 
+    # Whether instances are served from memcache by get_cached()
+    cached = False
+
+    last_modified = db.DateTimeProperty(auto_now=True)
+
+    @classmethod
+    def changed_since(cls, since):
+        """Returns a query for the entities of this kind changed after the
+        given time, oldest change first."""
+        return cls.all()\
+            .filter('last_modified >', since)\
+            .order('last_modified')
+
+    def put(self, **kwargs):
+        key = super(BaseModel, self).put(**kwargs)
+        # Inside a transaction the write hasn't happened yet, so the caller
+        # has to uncache() once it commits
+        if self.cached and not db.is_in_transaction():
+            uncache([key])
+        return key
+
     @property
     def source_url(self):
         return '%s%s' % (self.host, self.make_source_url())
@@ -41,6 +232,7 @@ class BaseModel(db.Model):
 
 
 class Sector(BaseModel):
+    cached = True
     name = db.StringProperty()
 
     def make_source_url(self):
@@ -51,17 +243,23 @@ class Sector(BaseModel):
 
 
 class Author(BaseModel):
+    cached = True
     username = db.StringProperty()
     idea_count = db.IntegerProperty(default=0)
     post_count = db.IntegerProperty(default=0)
+    contribution_count = DerivedProperty(
+        lambda self: self.idea_count + self.post_count)
 
     @property
     def ideas(self):
         return Idea.all().filter('author =', self)
 
-    @property
-    def contribution_count(self):
-        return self.idea_count + self.post_count
+    @classmethod
+    def leaderboard(cls):
+        return cls.all()\
+            .order('-contribution_count')\
+            .order('-idea_count')\
+            .order('-post_count')
 
     def make_source_url(self):
         return '/User/View?userid=%s' % self.key().id()
@@ -74,6 +272,9 @@ class Post(BaseModel):
     body = db.TextProperty()
     author = db.ReferenceProperty(Author, collection_name='posts')
     papa = db.ReferenceProperty(collection_name='posts') # parent post
+    root = db.ReferenceProperty(collection_name='thread_posts') # root idea
+    # The key this post had before migrations.GroupThreads moved it
+    moved_from = db.StringProperty(indexed=False)
 
     upvotes = db.IntegerProperty(default=0)
     downvotes = db.IntegerProperty(default=0)
@@ -84,9 +285,21 @@ class Post(BaseModel):
     def papa_key(self):
         return self.__class__.papa.get_value_for_datastore(self)
 
+    @property
+    def root_key(self):
+        """The key of this post's idea, if it is known without fetching
+        anything, else None."""
+        if self.papa_key is None:
+            return self.key()
+        # Posts stored in their idea's entity group
+        return self.key().parent() or \
+            Post.root.get_value_for_datastore(self)
+
     def get_idea(self):
         if self.papa_key is None:
             return self
+        elif self.root_key is not None:
+            return get_cached(self.root_key)
         else:
             idea = self.papa
             while idea.papa_key is not None:
@@ -94,21 +307,110 @@ class Post(BaseModel):
             return idea
 
     def make_local_url(self):
-        idea = self.get_idea()
-        return '/idea/%s#post:%s' % (idea.key().id(), self.key().id())
+        root_key = self.root_key or self.get_idea().key()
+        return '/idea/%s#post:%s' % (root_key.id(), self.key().id())
 
     def __unicode__(self):
         return u'Post:%s' % self.key().id()
 
 
 class Idea(Post):
+    cached = True
     title = db.StringProperty()
     sector = db.ReferenceProperty(Sector, collection_name='ideas')
     stage = db.StringProperty(choices=STAGES)
     views = db.IntegerProperty(default=0)
+    # Views on this site (as opposed to the source site), kept up to date by
+    # a sharded counter, see counters.py
+    local_views = db.IntegerProperty(default=0)
+    # The number of posts in this idea's thread, as of the last import
+    reply_count = db.IntegerProperty(default=0)
+
+    @property
+    def sector_key(self):
+        return Idea.sector.get_value_for_datastore(self)
 
     def make_source_url(self):
         return '/Idea/View?ideaid=%s' % self.key().id()
 
+    def thread(self):
+        """Returns a query for every post in this idea's thread, oldest
+        first.  If posts are stored in their idea's entity group (see
+        settings.THREAD_ENTITY_GROUPS) this is a strongly consistent ancestor
+        query, otherwise it relies on each post's root."""
+        if settings.THREAD_ENTITY_GROUPS:
+            q = Post.all().ancestor(self)
+        else:
+            q = Post.all().filter('root =', self)
+        return q.order('created_at')
+
+    def get_replies(self):
+        """Loads this idea's whole thread with a single query and assembles
+        it in memory.  Returns the top-level replies, each of which (like
+        every reply below it) has its own replies in a `replies` list."""
+        posts = self.thread().fetch(1000)
+        if not posts and not settings.THREAD_ENTITY_GROUPS:
+            # Threads imported before posts stored their root can only be
+            # found by walking them, until migrations.SetRoots has run.
+            # reply_count can't tell us whether to bother, since it isn't
+            # set on those ideas either, but for a thread that really is
+            # empty this is just one more query.
+            from migrations import walk_thread
+            posts = sorted(walk_thread(self),
+                           key=lambda post: post.created_at)
+        prefetch_references(posts, 'author')
+        children = {}
+        for post in posts:
+            children.setdefault(post.papa_key, []).append(post)
+        for post in posts:
+            post.replies = children.get(post.key(), [])
+        return children.get(self.key(), [])
+
     def __unicode__(self):
         return self.title
+
+
+class TagStat(db.Model):
+    """The number of entities of one kind that carry one tag, optionally only
+    counting those in a given stage or sector.  Keyed by a name built with
+    name_for(), and maintained by tagstats.py."""
+    count = db.IntegerProperty(default=0, indexed=False)
+
+    @staticmethod
+    def name_for(kind, tag, facet=None, value=None):
+        parts = [kind, tag]
+        if facet is not None:
+            parts.extend([facet, unicode(value)])
+        return u'|'.join(parts)
+
+    @classmethod
+    def get_counts(cls, kinds, tags, facet=None, value=None):
+        """Returns a dict mapping (kind, tag) pairs to counts, with a single
+        batched get."""
+        pairs = [(kind, tag) for kind in kinds for tag in tags]
+        keys = [db.Key.from_path(cls.kind(),
+                                 cls.name_for(kind, tag, facet, value))
+                for kind, tag in pairs]
+        stats = cls.get(keys)
+        return dict((pair, stat and stat.count or 0)
+                    for pair, stat in zip(pairs, stats))
+
+
+class RefreshSchedule(db.Model):
+    """Tracks when an idea's thread should next be re-crawled.  Keyed by the
+    idea's id (as a key name) so it can be fetched without a query."""
+    stage = db.StringProperty(choices=STAGES)
+    next_refresh = db.DateTimeProperty()
+    last_refreshed = db.DateTimeProperty(indexed=False)
+    last_changed = db.DateTimeProperty(indexed=False)
+    reply_count = db.IntegerProperty(default=0, indexed=False)
+    # Smoothed number of new replies per day
+    reply_rate = db.FloatProperty(default=0.0, indexed=False)
+
+    @property
+    def idea_id(self):
+        return int(self.key().name())
+
+    @classmethod
+    def key_for(cls, idea_id):
+        return db.Key.from_path(cls.kind(), str(idea_id))
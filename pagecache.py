@@ -0,0 +1,215 @@
+"""Caches the rendered output of GET handlers, so that repeat views skip
+both the datastore and the templates:
+
+    class IndexHandler(BaseHandler):
+        @cache_page
+        def get(self):
+            ...
+
+Pages are cached in memcache and in a small LRU cache local to each
+instance, keyed by the request's path and query string and by the current
+data generation (see models.get_generation).  Whatever bumps the generation
+therefore invalidates every cached page at once, and nothing has to be
+deleted explicitly.
+
+The same generation makes a strong ETag for each page, and the time it was
+last bumped serves as the page's Last-Modified date, so browsers that
+revalidate get a bodiless 304 without anything being rendered at all.
+
+Pages are stored gzipped, so they are compressed once per generation, and
+sent as they are to clients that accept gzip (see send_body()).
+"""
+
+import calendar
+import datetime
+import email.utils
+import gzip
+import hashlib
+from cStringIO import StringIO
+from functools import wraps
+
+from google.appengine.api import memcache
+
+from models import get_generation
+
+
+# How long (in seconds) rendered pages live in memcache
+PAGE_CACHE_TIME = 60 * 60
+
+# How many rendered pages each instance keeps in memory
+LOCAL_CACHE_SIZE = 100
+
+# Pages may be stored anywhere, but must be revalidated before reuse since
+# they change whenever an import runs
+PAGE_CACHE_CONTROL = 'public, max-age=0, must-revalidate'
+
+# Bodies smaller than this (in bytes) aren't worth compressing
+MIN_GZIP_SIZE = 1024
+
+
+class LRUCache(object):
+    """A dict-like cache that holds at most max_size items, dropping the
+    least recently used one to make room."""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.items = {}
+        self.tick = 0
+
+    def get(self, key, default=None):
+        if key not in self.items:
+            return default
+        self.tick += 1
+        value = self.items[key][1]
+        self.items[key] = (self.tick, value)
+        return value
+
+    def set(self, key, value):
+        self.tick += 1
+        self.items[key] = (self.tick, value)
+        if len(self.items) > self.max_size:
+            oldest = min(self.items, key=lambda k: self.items[k][0])
+            del self.items[oldest]
+
+    def clear(self):
+        self.items.clear()
+
+local_cache = LRUCache(LOCAL_CACHE_SIZE)
+
+
+def page_key(request, generation):
+    digest = hashlib.md5(request.path_qs).hexdigest()
+    return 'rendered-gzip:%s:%s' % (generation, digest)
+
+def page_etag(request, generation):
+    # Compressed and uncompressed pages are different representations
+    return '"%s-%s%s"' % (generation,
+                          hashlib.md5(request.path_qs).hexdigest()[:16],
+                          accepts_gzip(request) and '-gzip' or '')
+
+def get_page(key):
+    """Returns the (content type, body, whether the body is gzipped) of the
+    cached page with the given key, or None."""
+    page = local_cache.get(key)
+    if page is None:
+        page = memcache.get(key)
+        if page is not None:
+            local_cache.set(key, page)
+    return page
+
+def set_page(key, page):
+    local_cache.set(key, page)
+    memcache.set(key, page, time=PAGE_CACHE_TIME)
+
+def cache_page(get):
+    """Decorates a handler's get() so that its successful responses are
+    cached and served from the cache while the data generation stands."""
+    @wraps(get)
+    def decorated(self, *args):
+        generation, changed_at = get_generation()
+        if not_modified(self, page_etag(self.request, generation),
+                        changed_at, PAGE_CACHE_CONTROL):
+            return
+        key = page_key(self.request, generation)
+        page = get_page(key)
+        if page is not None:
+            content_type, body, gzipped = page
+            self.response.headers['Content-Type'] = content_type
+            send_body(self, body, gzipped)
+            return
+        result = get(self, *args)
+        if self.response.status == 200:
+            body, gzipped = compress(self.response.out.getvalue())
+            set_page(key, (self.response.headers['Content-Type'], body,
+                           gzipped))
+            self.response.clear()
+            send_body(self, body, gzipped)
+        else:
+            # Don't let errors be revalidated as though they were the page
+            for name in ('ETag', 'Last-Modified'):
+                del self.response.headers[name]
+            self.response.headers['Cache-Control'] = 'no-cache'
+        return result
+    return decorated
+
+def accepts_gzip(request):
+    return 'gzip' in request.headers.get('Accept-Encoding', '')
+
+def compress(body):
+    """Returns the given body, gzipped if it is worth it, along with whether
+    it was."""
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+    if len(body) < MIN_GZIP_SIZE:
+        return body, False
+    buf = StringIO()
+    f = gzip.GzipFile(mode='wb', fileobj=buf)
+    f.write(body)
+    f.close()
+    return buf.getvalue(), True
+
+def decompress(body):
+    return gzip.GzipFile(fileobj=StringIO(body)).read()
+
+def send_body(handler, body, gzipped=None):
+    """Writes the given body to the handler's response, gzipped if the
+    client accepts it.  gzipped says whether the body has already been
+    compressed; if None, it is compressed here if it's worth it."""
+    if gzipped is None:
+        body, gzipped = compress(body)
+    response = handler.response
+    response.headers['Vary'] = 'Accept-Encoding'
+    if gzipped:
+        if accepts_gzip(handler.request):
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            body = decompress(body)
+    response.out.write(body)
+
+def not_modified(handler, etag, last_modified=None, cache_control=None):
+    """Sets the given validators (and Cache-Control header) on the handler's
+    response, and checks them against the request's If-None-Match and
+    If-Modified-Since headers.  If the client's copy is still current, the
+    response is made a 304 and True is returned, and the caller should write
+    nothing further."""
+    request, response = handler.request, handler.response
+    response.headers['ETag'] = etag
+    if last_modified is not None:
+        response.headers['Last-Modified'] = http_date(last_modified)
+    if cache_control is not None:
+        response.headers['Cache-Control'] = cache_control
+
+    if_none_match = request.headers.get('If-None-Match')
+    if_modified_since = request.headers.get('If-Modified-Since')
+    if request.method not in ('GET', 'HEAD'):
+        current = False
+    elif if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        current = etag in tags or '*' in tags
+    elif if_modified_since and last_modified is not None:
+        since = parse_http_date(if_modified_since)
+        current = since is not None and \
+            last_modified.replace(microsecond=0) <= since
+    else:
+        current = False
+    if current:
+        handler.response.set_status(304)
+    return current
+
+def content_etag(body, gzipped=False):
+    """Returns a strong ETag for the given (uncompressed) response body,
+    which differs depending on whether it is sent gzipped."""
+    return '"%s%s"' % (hashlib.md5(body).hexdigest(),
+                       gzipped and '-gzip' or '')
+
+def http_date(dt):
+    """Formats the given (UTC) datetime for an HTTP header."""
+    return email.utils.formatdate(calendar.timegm(dt.utctimetuple()),
+                                  usegmt=True)
+
+def parse_http_date(value):
+    parsed = email.utils.parsedate(value)
+    if parsed is None:
+        return None
+    return datetime.datetime(*parsed[:6])
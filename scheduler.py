@@ -0,0 +1,160 @@
+"""Decides which idea threads to re-crawl, and when.
+
+Each idea has a RefreshSchedule whose next_refresh is derived from its stage,
+how quickly replies have been arriving and how long the thread has been
+quiet.  A cron job calls enqueue_due() periodically, which hands at most
+FETCH_BUDGET due ideas to the refresh queue; each task then calls
+refresh_idea() to re-import the thread and reschedule it.
+"""
+
+import datetime
+import logging
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+
+import importer
+from models import Idea, RefreshSchedule
+
+
+# Baseline polling interval (in seconds) for each stage
+HOUR = 60 * 60
+DAY = 24 * HOUR
+STAGE_INTERVALS = {
+    'Incubation': 1 * HOUR,
+    'Validation': 2 * HOUR,
+    'Emergence': 12 * HOUR,
+    'Closed': 7 * DAY,
+    'Aborted': 7 * DAY,
+    }
+DEFAULT_INTERVAL = 1 * DAY
+
+# Bounds on any computed interval
+MIN_INTERVAL = 15 * 60
+MAX_INTERVAL = 30 * DAY
+
+# Quiet threads back off by up to this multiple of their stage interval
+MAX_BACKOFF = 8
+
+# Weight given to the newest observation when smoothing the reply rate
+RATE_SMOOTHING = 0.5
+
+# The most ideas a single cron tick will enqueue
+FETCH_BUDGET = 50
+
+# While a refresh is queued, its idea is not considered due again for this
+# long, so that overlapping ticks don't enqueue it twice.
+LEASE = 1 * HOUR
+
+QUEUE_NAME = 'refresh'
+REFRESH_URL = '/tasks/refresh/idea'
+
+
+def refresh_interval(schedule, now):
+    """Returns the number of seconds to wait before refreshing the thread
+    tracked by the given schedule again."""
+    base = STAGE_INTERVALS.get(schedule.stage, DEFAULT_INTERVAL)
+
+    # Busy threads are polled proportionally more often
+    interval = base / (1.0 + schedule.reply_rate)
+
+    # Threads that haven't changed in a while are polled less often
+    if schedule.last_changed:
+        quiet = seconds(now - schedule.last_changed)
+        interval *= min(MAX_BACKOFF, max(1.0, quiet / float(base)))
+
+    return max(MIN_INTERVAL, min(MAX_INTERVAL, interval))
+
+def record_refresh(schedule, reply_count, now):
+    """Updates the given schedule after its thread has been re-imported and
+    found to contain reply_count replies."""
+    new_replies = max(0, reply_count - schedule.reply_count)
+    if schedule.last_refreshed:
+        elapsed = max(1.0, seconds(now - schedule.last_refreshed))
+        observed = new_replies * DAY / elapsed
+        schedule.reply_rate = (RATE_SMOOTHING * observed +
+                               (1 - RATE_SMOOTHING) * schedule.reply_rate)
+    if new_replies or schedule.last_changed is None:
+        schedule.last_changed = now
+    schedule.reply_count = reply_count
+    schedule.last_refreshed = now
+    schedule.next_refresh = now + datetime.timedelta(
+        seconds=refresh_interval(schedule, now))
+    return schedule
+
+def enqueue_due(budget=FETCH_BUDGET, now=None):
+    """Enqueues a refresh task for each idea whose schedule is due, up to
+    the given budget.  Returns the schedules that were enqueued."""
+    now = now or datetime.datetime.now()
+    due = RefreshSchedule.all()\
+        .filter('next_refresh <=', now)\
+        .order('next_refresh')\
+        .fetch(budget)
+
+    lease = now + datetime.timedelta(seconds=LEASE)
+    for schedule in due:
+        taskqueue.add(url=REFRESH_URL, queue_name=QUEUE_NAME,
+                      params={'id': schedule.idea_id})
+        schedule.next_refresh = lease
+    db.put(due)
+
+    logging.info('Enqueued %s idea refresh(es)', len(due))
+    return due
+
+def refresh_idea(idea_id, now=None):
+    """Re-imports the thread for the given idea and reschedules it."""
+    now = now or datetime.datetime.now()
+    idea = Idea.get_by_id(idea_id)
+    if idea is None:
+        logging.warning('Idea %s no longer exists, unscheduling', idea_id)
+        db.delete(RefreshSchedule.key_for(idea_id))
+        return None
+
+    writer = importer.BatchWriter()
+    reply_count = importer.import_thread(idea, writer)
+    writer.flush()
+
+    return reschedule(idea, reply_count, now)
+
+def reschedule(idea, reply_count, now=None):
+    """Records that the given idea's thread was just re-imported with
+    reply_count replies, and schedules its next refresh."""
+    now = now or datetime.datetime.now()
+    key = RefreshSchedule.key_for(idea.key().id())
+    schedule = RefreshSchedule.get(key) or new_schedule(idea, now)
+    schedule.stage = idea.stage
+    record_refresh(schedule, reply_count, now)
+    schedule.put()
+    return schedule
+
+def refresh_listing(now=None):
+    """Re-imports the idea listing, which carries every idea's stage, votes
+    and views, and brings the schedules in line with it.  New ideas, and
+    ideas that changed stage, become due immediately."""
+    now = now or datetime.datetime.now()
+    ideas = importer.import_ideas()
+
+    keys = [RefreshSchedule.key_for(idea.key().id()) for idea in ideas]
+    schedules = RefreshSchedule.get(keys)
+
+    to_put = []
+    for idea, schedule in zip(ideas, schedules):
+        if schedule is None:
+            to_put.append(new_schedule(idea, now))
+        elif schedule.stage != idea.stage:
+            schedule.stage = idea.stage
+            schedule.next_refresh = now
+            to_put.append(schedule)
+    db.put(to_put)
+
+    logging.info('Scheduled %s new or changed idea(s)', len(to_put))
+    return to_put
+
+def new_schedule(idea, now):
+    return RefreshSchedule(
+        key=RefreshSchedule.key_for(idea.key().id()),
+        stage=idea.stage,
+        next_refresh=now)
+
+def seconds(delta):
+    return delta.days * DAY + delta.seconds + delta.microseconds / 1e6
@@ -0,0 +1,4 @@
+# Store each Post in its root Idea's entity group, so that a whole thread can
+# be loaded with a single, strongly consistent ancestor query.  Existing data
+# can be moved over with migrations.GroupThreads().start().
+THREAD_ENTITY_GROUPS = False
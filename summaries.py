@@ -0,0 +1,298 @@
+"""Lightweight, read-only summaries of ideas, posts and authors for listing
+pages.
+
+Listings only need a title, a few counts and some links, so instead of full
+model instances (bodies and all) they render these __slots__ objects.  Each
+summary round-trips through a plain tuple, which is what gets cached: see
+PageFetch.
+
+The index page goes further and reads the summaries of every idea, grouped
+by stage, from a few pre-built SummaryChunk entities.  Those are rebuilt by a
+deferred task whenever an import touches a stage: see defer_rebuild().
+"""
+
+import cPickle as pickle
+import hashlib
+import logging
+import time
+
+from google.appengine.api import memcache
+from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from models import Idea, Post, Author, Sector, STAGES
+from models import prefetch_references, get_cached, uncache, get_generation
+
+
+# How long (in seconds) cached projections live in memcache
+PROJECTION_CACHE_TIME = 60 * 60
+
+
+class Summary(object):
+    __slots__ = ()
+
+    def __init__(self, *values):
+        for name, value in zip(self.__slots__, values):
+            setattr(self, name, value)
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name in self.__slots__)
+
+    def __str__(self):
+        return unicode(self).encode('utf-8')
+
+
+class IdeaSummary(Summary):
+    __slots__ = ('id', 'title', 'stage', 'author_id', 'author_name',
+                 'sector_id', 'sector_name', 'upvotes', 'downvotes', 'views',
+                 'reply_count')
+
+    @classmethod
+    def from_entity(cls, idea):
+        author_key = Idea.author.get_value_for_datastore(idea)
+        sector_key = Idea.sector.get_value_for_datastore(idea)
+        return cls(idea.key().id(), idea.title, idea.stage,
+                   author_key and author_key.id(),
+                   idea.author and idea.author.username,
+                   sector_key and sector_key.id(),
+                   idea.sector and idea.sector.name,
+                   idea.upvotes, idea.downvotes, idea.views,
+                   idea.reply_count)
+
+    def __unicode__(self):
+        return self.title
+
+
+class PostSummary(Summary):
+    __slots__ = ('id', 'url', 'author_id', 'author_name', 'papa_name')
+
+    @classmethod
+    def from_entity(cls, post):
+        author_key = Post.author.get_value_for_datastore(post)
+        return cls(post.key().id(), post.make_local_url(),
+                   author_key and author_key.id(),
+                   post.author and post.author.username,
+                   post.papa and unicode(post.papa))
+
+    def __unicode__(self):
+        return u'Post:%s' % self.id
+
+
+class AuthorSummary(Summary):
+    __slots__ = ('id', 'username', 'idea_count', 'post_count',
+                 'contribution_count')
+
+    @classmethod
+    def from_entity(cls, author):
+        return cls(author.key().id(), author.username, author.idea_count,
+                   author.post_count, author.contribution_count)
+
+    def __unicode__(self):
+        return self.username
+
+
+def summarize(entities):
+    """Builds the appropriate summary for each of the given entities, with
+    their references prefetched in one batch."""
+    prefetch_references(entities, 'author', 'sector', 'papa')
+    return [summary_class(entity).from_entity(entity)
+            for entity in entities]
+
+def summary_class(entity):
+    if isinstance(entity, Idea):
+        return IdeaSummary
+    elif isinstance(entity, Post):
+        return PostSummary
+    else:
+        return AuthorSummary
+
+
+class InvalidCursorError(ValueError):
+    """Raised for a cursor that is malformed or belongs to another query."""
+
+
+class PageFetch(object):
+    """Fetches pages of summaries of several listings at once, from
+    memcache where possible.  Cached pages go stale whenever the data
+    generation is bumped.  The queries for every page missing from memcache
+    are started when the PageFetch is created, and only waited on by
+    get_result(), so they run concurrently with each other and with
+    whatever the caller does in between.  The references of all their
+    results are prefetched in a single batch."""
+
+    def __init__(self, requests):
+        """Takes a list of (name, cls, query, cursor, size) tuples."""
+        generation, changed_at = get_generation()
+        self.requests = requests
+        self.keys = [page_key(generation, name, size, cursor)
+                     for name, cls, query, cursor, size in requests]
+        self.pages = memcache.get_multi(self.keys)
+        self.runs = {}
+        for key, (name, cls, query, cursor, size) in zip(self.keys, requests):
+            if key not in self.pages:
+                try:
+                    if cursor:
+                        query.with_cursor(cursor)
+                    # run() sends the query off without waiting for its
+                    # results
+                    self.runs[key] = query.run(limit=size, batch_size=size)
+                except (db.BadValueError, db.BadRequestError), e:
+                    raise InvalidCursorError(str(e))
+
+    def get_result(self):
+        """Returns a (summaries, next cursor) pair for each page."""
+        fetched = []
+        for key, (name, cls, query, cursor, size) in \
+                zip(self.keys, self.requests):
+            if key in self.runs:
+                try:
+                    entities = list(self.runs[key])
+                except db.BadRequestError, e:
+                    raise InvalidCursorError(str(e))
+                next_cursor = len(entities) == size and query.cursor() or None
+                fetched.append((key, entities, next_cursor))
+
+        if fetched:
+            summaries = summarize([entity for key, entities, next_cursor
+                                   in fetched for entity in entities])
+            new_pages = {}
+            for key, entities, next_cursor in fetched:
+                rows = [summary.to_tuple()
+                        for summary in summaries[:len(entities)]]
+                summaries = summaries[len(entities):]
+                new_pages[key] = (rows, next_cursor)
+            memcache.set_multi(new_pages, time=PROJECTION_CACHE_TIME)
+            self.pages.update(new_pages)
+
+        results = []
+        for key, (name, cls, query, cursor, size) in \
+                zip(self.keys, self.requests):
+            rows, next_cursor = self.pages[key]
+            results.append(([cls(*row) for row in rows], next_cursor))
+        return results
+
+
+def page_key(generation, name, size, cursor):
+    # Cursors are too long to go into memcache keys as they are
+    digest = hashlib.md5('%s:%s:%s' % (name, size, cursor or '')).hexdigest()
+    return 'page:%s:%s' % (generation, digest)
+
+
+# How many idea summaries are stored in each SummaryChunk
+CHUNK_SIZE = 250
+
+# How long (in seconds) rebuilds are put off, so that every change to a
+# stage within that time is covered by a single rebuild
+REBUILD_DELAY = 30
+
+
+class SummaryChunk(db.Model):
+    """A slice of the IdeaSummary rows for one stage, keyed by
+    '<stage>:<chunk index>'.  The first chunk of each stage also records how
+    many chunks there are and how many ideas they hold."""
+    cached = True
+    rows = db.BlobProperty()
+    chunks = db.IntegerProperty(default=1, indexed=False)
+    total = db.IntegerProperty(default=0, indexed=False)
+
+    @property
+    def summaries(self):
+        return [IdeaSummary(*row) for row in pickle.loads(self.rows)]
+
+
+def chunk_key(stage, index):
+    return db.Key.from_path(SummaryChunk.kind(), '%s:%d' % (stage, index))
+
+def get_stage_summaries(stages=None, limit=None):
+    """Returns a (stage, summaries, total) tuple for each of the given stages
+    (or every stage), reading only their SummaryChunks.  If a limit is given,
+    only the first limit summaries of each stage are returned, and only the
+    chunks holding them are read.  Stages that have never been summarized
+    are rebuilt on the spot."""
+    stages = list(stages or STAGES)
+    firsts = get_cached([chunk_key(stage, 0) for stage in stages])
+    for i, stage in enumerate(stages):
+        if firsts[i] is None:
+            firsts[i] = rebuild_stage(stage)[0]
+
+    def needed(first):
+        if limit is None:
+            return first.chunks
+        return min(first.chunks, (limit + CHUNK_SIZE - 1) / CHUNK_SIZE)
+    rest = get_cached([chunk_key(stage, n)
+                       for stage, first in zip(stages, firsts)
+                       for n in range(1, needed(first))])
+    results = []
+    for stage, first in zip(stages, firsts):
+        count = max(0, needed(first) - 1)
+        summaries = first.summaries
+        for chunk in rest[:count]:
+            if chunk is not None:
+                summaries.extend(chunk.summaries)
+        rest = rest[count:]
+        results.append((stage, summaries[:limit], first.total))
+    return results
+
+def rebuild_stage(stage):
+    """Re-summarizes every idea in the given stage into its SummaryChunks,
+    and returns them."""
+    q = Idea.all().filter('stage =', stage)
+    rows = []
+    while True:
+        ideas = q.fetch(CHUNK_SIZE)
+        rows.extend(summary.to_tuple() for summary in summarize(ideas))
+        if len(ideas) < CHUNK_SIZE:
+            break
+        q.with_cursor(q.cursor())
+
+    old = SummaryChunk.get(chunk_key(stage, 0))
+    slices = [rows[i:i + CHUNK_SIZE]
+              for i in range(0, len(rows), CHUNK_SIZE)] or [[]]
+    chunks = [SummaryChunk(key=chunk_key(stage, i), chunks=len(slices),
+                           total=len(rows),
+                           rows=db.Blob(pickle.dumps(chunk_rows, 2)))
+              for i, chunk_rows in enumerate(slices)]
+    db.put(chunks)
+    if old is not None and old.chunks > len(chunks):
+        db.delete([chunk_key(stage, i)
+                   for i in range(len(chunks), old.chunks)])
+    uncache([chunk_key(stage, i)
+             for i in range(max(len(chunks), old and old.chunks or 0))])
+    logging.info('Summarized %s idea(s) in stage %s', len(rows), stage)
+    return chunks
+
+def rebuild_stages(stages):
+    for stage in stages:
+        rebuild_stage(stage)
+
+def defer_rebuild(entities):
+    """Schedules a rebuild of the SummaryChunks of every stage affected by
+    the given (just written) entities.  Authors and sectors can appear in
+    any stage, so renaming one (which the importer flags by setting its
+    renamed attribute) causes every stage to be rebuilt."""
+    stages = set()
+    root_keys = set()
+    for entity in entities:
+        if isinstance(entity, (Author, Sector)):
+            if getattr(entity, 'renamed', False):
+                stages.update(STAGES)
+                break
+        elif isinstance(entity, Idea):
+            stages.add(entity.stage)
+        elif isinstance(entity, Post) and entity.root_key is not None:
+            root_keys.add(entity.root_key)
+    else:
+        stages.update(idea.stage for idea in get_cached(list(root_keys))
+                      if idea is not None)
+    # Named tasks coalesce the rebuilds asked for within one interval
+    bucket = int(time.time() / REBUILD_DELAY)
+    for stage in stages:
+        if stage is None:
+            continue
+        try:
+            deferred.defer(rebuild_stages, [stage], _countdown=REBUILD_DELAY,
+                           _name='summarize-%s-%s' % (stage, bucket))
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            pass
@@ -0,0 +1,107 @@
+"""Tag completion for the tag inputs, which ask for choices on every
+keystroke.
+
+A TagIndex is built once per data generation from the tag vocabulary and
+each tag's usage count.  It keeps every tag's lowercased word prefixes and
+its short n-grams in dicts, so a lookup is a couple of dict hits (plus a
+set intersection for longer substrings) instead of a scan of every tag.
+Matches where the query starts the tag (or one of its words) come first,
+then other substring matches, each ordered by how often the tag is used.
+"""
+
+import re
+
+from google.appengine.api import memcache
+
+from models import TagStat, TAGS, get_generation
+from tagstats import ALL
+
+
+# The longest prefix and n-gram kept in the index.  Longer queries are
+# answered from the candidates their n-grams have in common.
+MAX_PREFIX = 12
+GRAM_SIZE = 3
+
+COUNTS_CACHE_TIME = 60 * 60
+
+WORD_START_RE = re.compile(r'(?:^|(?<=[^a-z0-9]))[a-z0-9]')
+
+
+class TagIndex(object):
+
+    def __init__(self, counts):
+        """Takes a dict mapping each tag to its usage count."""
+        self.tags = sorted(counts, key=lambda tag: (-counts[tag], tag.lower()))
+        self.rank = dict((tag, i) for i, tag in enumerate(self.tags))
+        self.lower = dict((tag, tag.lower()) for tag in self.tags)
+        self.words = {}
+        self.prefixes = {}
+        self.grams = {}
+        for tag in self.tags:
+            lower = self.lower[tag]
+            self.words[tag] = [lower[match.start():]
+                               for match in WORD_START_RE.finditer(lower)]
+            for word in self.words[tag]:
+                for i in range(1, min(len(word), MAX_PREFIX) + 1):
+                    self.prefixes.setdefault(word[:i], set()).add(tag)
+            for size in range(1, GRAM_SIZE + 1):
+                for i in range(len(lower) - size + 1):
+                    self.grams.setdefault(lower[i:i + size], set()).add(tag)
+
+    def complete(self, q, limit=10):
+        """Returns up to limit tags matching the given query, best first."""
+        q = q.strip().lower()
+        if not q:
+            return self.tags[:limit]
+
+        if len(q) <= GRAM_SIZE:
+            substrings = self.grams.get(q, set())
+        else:
+            grams = [q[i:i + GRAM_SIZE]
+                     for i in range(len(q) - GRAM_SIZE + 1)]
+            candidates = reduce(set.intersection,
+                                [self.grams.get(gram, set()) for gram in grams])
+            substrings = set(tag for tag in candidates
+                             if q in self.lower[tag])
+
+        if len(q) <= MAX_PREFIX:
+            prefixes = self.prefixes.get(q, set())
+        else:
+            prefixes = set(tag for tag in substrings
+                           if [word for word in self.words[tag]
+                               if word.startswith(q)])
+        by_rank = lambda tags: sorted(tags, key=self.rank.get)
+        return (by_rank(prefixes) + by_rank(substrings - prefixes))[:limit]
+
+
+def load_counts():
+    """Returns a dict mapping every known tag (the built-in TAGS and any
+    others that have been counted) to the number of ideas and posts that
+    carry it."""
+    tags = set(TAGS)
+    for key in TagStat.all(keys_only=True):
+        parts = key.name().split('|')
+        if len(parts) == 2 and parts[1] != ALL:
+            tags.add(parts[1])
+    tags = list(tags)
+    counts = TagStat.get_counts(('Idea', 'Post'), tags)
+    return dict((tag, counts[('Idea', tag)] + counts[('Post', tag)])
+                for tag in tags)
+
+# The index for the current generation, built at most once per instance
+_index = (None, None)
+
+def get_index():
+    global _index
+    generation, changed_at = get_generation()
+    if _index[0] != generation:
+        key = 'tag-counts:%s' % generation
+        counts = memcache.get(key)
+        if counts is None:
+            counts = load_counts()
+            memcache.set(key, counts, time=COUNTS_CACHE_TIME)
+        _index = (generation, TagIndex(counts))
+    return _index[1]
+
+def complete(q, limit=10):
+    return get_index().complete(q, limit)
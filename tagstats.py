@@ -0,0 +1,184 @@
+"""Maintains TagStat counts of how many Ideas and Posts carry each tag,
+overall and within each stage and sector (a Post counts towards its idea's
+stage and sector).
+
+Counts are adjusted incrementally: the importer counts the entities it
+creates, and tag edits enqueue record_change() transactionally with the
+edit itself.  When an import moves an idea to another stage or sector,
+move_thread() moves its replies' counts along with it.  rebuild() recounts
+everything from scratch, should anything drift.
+
+Every entity also counts towards the ALL pseudo-tag, whatever its tags, so
+the same TagStats give the number of ideas and posts in each stage and
+sector (see facets.py).
+"""
+
+import cPickle as pickle
+import hashlib
+import logging
+
+from google.appengine.ext import db
+from google.appengine.ext import deferred
+
+from mapper import Mapper
+from models import Idea, Post, TagStat, get_cached, bump_generation
+import settings
+
+
+# The pseudo-tag carried by every entity
+ALL = '*'
+
+
+class TagDeltas(object):
+    """Accumulates changes to TagStat counts, to be applied in one go."""
+
+    def __init__(self):
+        self.deltas = {}
+
+    def count(self, entity, sign=1, tags=None, idea=None):
+        """Counts the given entity's tags (or the given tags) once, with the
+        given sign.  The idea whose stage and sector apply is looked up
+        unless given."""
+        if tags is None:
+            tags = entity.tags
+        for name in stat_names(entity, tags, idea):
+            self.deltas[name] = self.deltas.get(name, 0) + sign
+
+    def apply(self):
+        """Applies the accumulated changes via a deferred task."""
+        deltas = dict((name, delta) for name, delta in self.deltas.iteritems()
+                      if delta)
+        if deltas:
+            deferred.defer(apply_deltas, deltas)
+        self.deltas = {}
+
+
+def stat_names(entity, tags, idea=None):
+    """Returns the names of the TagStats that the given entity counts towards
+    with the given tags."""
+    kind = entity.kind()
+    if idea is None:
+        idea = find_idea(entity)
+    names = []
+    for tag in list(tags) + [ALL]:
+        names.append(TagStat.name_for(kind, tag))
+        if idea is not None:
+            names.append(TagStat.name_for(kind, tag, 'stage', idea.stage))
+            if idea.sector_key is not None:
+                names.append(TagStat.name_for(
+                    kind, tag, 'sector', idea.sector_key.id()))
+    return names
+
+def find_idea(entity):
+    if isinstance(entity, Idea):
+        return entity
+    root_key = entity.root_key
+    return root_key and get_cached(root_key) or None
+
+def apply_deltas(deltas):
+    """Adds each delta to the named TagStat, one transaction apiece."""
+    def txn(name, delta):
+        key = db.Key.from_path(TagStat.kind(), name)
+        stat = TagStat.get(key) or TagStat(key=key)
+        stat.count = max(0, stat.count + delta)
+        stat.put()
+    for name, delta in deltas.iteritems():
+        db.run_in_transaction(txn, name, delta)
+    bump_generation()
+
+def record_change(key, old_tags, new_tags):
+    """Adjusts the counts for an entity whose tags were changed.  Run as a
+    transactional task by whatever changed the tags."""
+    record_changes([(key, old_tags, new_tags)])
+
+def record_changes(changes):
+    """Like record_change(), for a list of (key, old tags, new tags)
+    triples, with a single batched get."""
+    entities = db.get([key for key, old_tags, new_tags in changes])
+    deltas = TagDeltas()
+    for entity, (key, old_tags, new_tags) in zip(entities, changes):
+        if entity is None:
+            continue
+        idea = find_idea(entity)
+        deltas.count(entity, -1, tags=old_tags, idea=idea)
+        deltas.count(entity, 1, tags=new_tags, idea=idea)
+    apply_deltas(deltas.deltas)
+
+def move_thread(idea_key, old_stage, old_sector_key):
+    """Moves the counts of an idea's replies from the stage and sector the
+    idea had to the ones it has now.  Deferred by the importer when it
+    changes an idea's stage or sector."""
+    idea = Idea.get(idea_key)
+    if idea is None:
+        return
+    posts = idea.thread().fetch(1000)
+    if not posts and not settings.THREAD_ENTITY_GROUPS:
+        from migrations import walk_thread
+        posts = list(walk_thread(idea))
+    old = Idea(key=idea_key, stage=old_stage, sector=old_sector_key)
+    deltas = TagDeltas()
+    for post in posts:
+        deltas.count(post, -1, idea=old)
+        deltas.count(post, idea=idea)
+    deltas.apply()
+
+
+class TagCountPart(db.Model):
+    """The counts from one batch of a RecountTags run, keyed by
+    '<mapper name>:<shard>:<cursor digest>', so that a re-run batch replaces
+    its own counts rather than adding to them."""
+    mapper = db.StringProperty()
+    counts = db.BlobProperty()
+
+
+class RecountTags(Mapper):
+    """Counts the tags on every entity of a kind, saving each batch's counts
+    as a TagCountPart and writing their totals to the TagStats once every
+    batch is done.  Runs on a single shard, since every batch counts largely
+    the same TagStats."""
+    SHARDS = 1
+
+    def __init__(self, kind):
+        super(RecountTags, self).__init__(kind)
+        self.deltas = TagDeltas()
+
+    def map(self, entity):
+        self.deltas.count(entity)
+        return [], []
+
+    def batch_done(self, shard, cursor):
+        digest = hashlib.md5(cursor or '').hexdigest()
+        TagCountPart(key_name='%s:%s:%s' % (self.name, shard, digest),
+                     mapper=self.name,
+                     counts=db.Blob(pickle.dumps(self.deltas.deltas, 2))).put()
+        self.deltas = TagDeltas()
+
+    def finish(self):
+        """Writes the summed counts, which are this kind's whole TagStats,
+        so it can safely be run again."""
+        q = TagCountPart.all().filter('mapper =', self.name)
+        totals, parts = {}, []
+        for part in q:
+            for name, count in pickle.loads(part.counts).iteritems():
+                totals[name] = totals.get(name, 0) + count
+            parts.append(part.key())
+        stats = [TagStat(key_name=name, count=count)
+                 for name, count in totals.iteritems()]
+        for i in range(0, len(stats), 500):
+            db.put(stats[i:i + 500])
+        bump_generation()
+        logging.info('%s counted %s TagStat(s)', self.name, len(stats))
+        for i in range(0, len(parts), 500):
+            db.delete(parts[i:i + 500])
+
+
+def rebuild():
+    """Recounts every TagStat from scratch.  Counts are incomplete until both
+    recounts have finished."""
+    while True:
+        keys = TagStat.all(keys_only=True).fetch(500)
+        if not keys:
+            break
+        db.delete(keys)
+    RecountTags(Idea).start()
+    RecountTags(Post).start()
@@ -0,0 +1,58 @@
+import logging
+
+from google.appengine.ext import webapp
+from google.appengine.ext.webapp.util import run_wsgi_app
+
+import counters
+import scheduler
+
+
+class RefreshTickHandler(webapp.RequestHandler):
+    """Run by cron to enqueue the idea threads that are due a refresh."""
+
+    def get(self):
+        budget = int(self.request.get('budget', scheduler.FETCH_BUDGET))
+        due = scheduler.enqueue_due(budget=budget)
+        self.response.out.write('Enqueued %s idea(s)' % len(due))
+
+
+class RefreshListingHandler(webapp.RequestHandler):
+    """Run by cron to pick up new ideas and stage changes."""
+
+    def get(self):
+        changed = scheduler.refresh_listing()
+        self.response.out.write('Scheduled %s idea(s)' % len(changed))
+
+
+class RefreshIdeaHandler(webapp.RequestHandler):
+    """Run from the refresh queue to re-crawl a single idea's thread."""
+
+    def post(self):
+        idea_id = int(self.request.get('id'))
+        schedule = scheduler.refresh_idea(idea_id)
+        if schedule is not None:
+            logging.info('Idea %s next refresh at %s',
+                         idea_id, schedule.next_refresh)
+
+
+class CounterFlushHandler(webapp.RequestHandler):
+    """Run from the counters queue to flush a counter's buffered delta."""
+
+    def post(self):
+        counters.flush(self.request.get('name'))
+
+
+urls = [
+    (r'^/tasks/refresh/tick$', RefreshTickHandler),
+    (r'^/tasks/refresh/listing$', RefreshListingHandler),
+    (r'^/tasks/refresh/idea$', RefreshIdeaHandler),
+    (r'^/tasks/counters/flush$', CounterFlushHandler),
+    ]
+
+application = webapp.WSGIApplication(urls, debug=True)
+
+def main():
+	run_wsgi_app(application)
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,52 @@
+import datetime
+import unittest
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from importer import find_post
+from models import Author, Idea, Post
+
+
+class FindPostTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        self.day = datetime.datetime(2010, 2, 13)
+        self.author = Author(key_name='a', username='someone')
+        self.author.put()
+        self.idea = Idea(key=db.Key.from_path('Idea', 1), author=self.author)
+        self.idea.put()
+        self.post = Post(papa=self.idea, root=self.idea, author=self.author,
+                         created_at=self.day, body=u'first')
+        self.post.put()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def find(self, body, on_page=1, exclude=()):
+        return find_post(self.idea, self.author, self.day, body,
+                         on_page=on_page, exclude=exclude)
+
+    def test_matching_body(self):
+        self.assertEqual(self.find(u'first').key(), self.post.key())
+        self.assertEqual(self.find(u'first', on_page=2).key(),
+                         self.post.key())
+
+    def test_edited_body(self):
+        self.assertEqual(self.find(u'edited').key(), self.post.key())
+
+    def test_second_reply_same_day(self):
+        self.assertEqual(self.find(u'second', on_page=2), None)
+
+    def test_already_matched(self):
+        matched = set([self.post.key()])
+        self.assertEqual(self.find(u'first', exclude=matched), None)
+        self.assertEqual(self.find(u'second', exclude=matched), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from google.appengine.ext import db
+from google.appengine.ext import testbed
+
+from models import Author, get_cached, prefetch_references
+
+
+class GetCachedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_empty_list(self):
+        self.assertEqual(get_cached([]), [])
+        self.assertEqual(get_cached(()), [])
+
+    def test_prefetch_nothing(self):
+        self.assertEqual(prefetch_references([], 'author'), [])
+
+    def test_single_and_multiple(self):
+        key = Author(username='someone').put()
+        missing = db.Key.from_path('Author', 12345)
+        self.assertEqual(get_cached(key).username, 'someone')
+        self.assertEqual(get_cached(missing), None)
+        authors = get_cached([key, missing])
+        self.assertEqual(authors[0].username, 'someone')
+        self.assertEqual(authors[1], None)
+
+
+if __name__ == '__main__':
+    unittest.main()